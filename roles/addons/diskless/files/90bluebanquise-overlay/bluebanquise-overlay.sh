@@ -0,0 +1,20 @@
+#!/bin/sh
+# Mount a tmpfs overlay on top of the read-only root, if asked on kernel
+# command line:
+#   rd.bluebanquise.overlay=tmpfs [rd.bluebanquise.overlay.size=50%]
+# Lower and upper layers stay reachable under /run/bluebanquise/.
+
+type getarg >/dev/null 2>&1 || . /lib/dracut-lib.sh
+
+[ "$(getarg rd.bluebanquise.overlay=)" = "tmpfs" ] || return 0
+
+overlay_size=$(getarg rd.bluebanquise.overlay.size=)
+[ -n "$overlay_size" ] || overlay_size=50%
+
+info "BlueBanquise: mounting tmpfs overlay of size $overlay_size on top of root"
+mkdir -p /run/bluebanquise/lower /run/bluebanquise/rw
+mount --move "$NEWROOT" /run/bluebanquise/lower || die "BlueBanquise: cannot move root to /run/bluebanquise/lower"
+mount -t tmpfs -o mode=0755,size="$overlay_size" tmpfs /run/bluebanquise/rw || die "BlueBanquise: cannot mount overlay tmpfs"
+mkdir -p /run/bluebanquise/rw/upper /run/bluebanquise/rw/work
+mount -t overlay -o lowerdir=/run/bluebanquise/lower,upperdir=/run/bluebanquise/rw/upper,workdir=/run/bluebanquise/rw/work overlay "$NEWROOT" \
+    || die "BlueBanquise: cannot mount overlay root"
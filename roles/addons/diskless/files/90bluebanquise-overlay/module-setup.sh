@@ -0,0 +1,25 @@
+#!/bin/bash
+# BlueBanquise diskless overlay root dracut module
+# https://github.com/bluebanquise/bluebanquise - MIT license
+#
+# Golden NFS image is mounted read-only as lower layer, and a tmpfs is
+# used as upper layer, for nodes writes. Enabled with kernel parameter
+# rd.bluebanquise.overlay=tmpfs.
+
+check() {
+    # Only included when asked (dracut --add bluebanquise-overlay)
+    return 255
+}
+
+depends() {
+    echo nfs
+    return 0
+}
+
+installkernel() {
+    instmods overlay
+}
+
+install() {
+    inst_hook pre-pivot 10 "$moddir/bluebanquise-overlay.sh"
+}
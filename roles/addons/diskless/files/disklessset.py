@@ -15,9 +15,15 @@
 import os
 import crypt
 import hashlib
+import json
 import re
 import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from subprocess import check_call
 
@@ -58,6 +64,202 @@ def load_kernel_list(kernels_path):
     return kernel_list
 
 
+def create_sparse_image(image_file, size):
+    # Sparse file: no data is written, blocks are allocated only when used
+    # by the image filesystem, and mksquashfs skips holes.
+    print(bcolors.OKBLUE+'[INFO] Creating sparse image file '+image_file+' of '+str(size)+'M'+bcolors.ENDC)
+    with open(image_file, 'wb') as f:
+        f.truncate(size * 1024 * 1024)
+    check_call(['mkfs.xfs', '-q', image_file])
+
+
+def file_sha256(filename, chunk_size=4*1024*1024):
+    # Read by chunks, memory usage does not depend on image size
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def squash_image(source, squashfs_file, compression, processors):
+    # Generated into a temporary file, as the image can be downloaded by
+    # booting nodes meanwhile. Returns the sha256 of the new image.
+    print(bcolors.OKBLUE+'[INFO] Generating '+squashfs_file+' ('+compression+' compression, '+str(processors)+' processors)'+bcolors.ENDC)
+    tmp_squashfs_file = squashfs_file+'.tmp'
+    if os.path.exists(tmp_squashfs_file):
+        os.remove(tmp_squashfs_file)
+    check_call(['mksquashfs', source, tmp_squashfs_file, '-noappend', '-comp', compression, '-processors', str(processors)])
+    sha256sum = file_sha256(tmp_squashfs_file)
+    os.replace(tmp_squashfs_file, squashfs_file)
+    return sha256sum
+
+
+def update_image_sha256(image_name, sha256sum):
+    metadata_file = os.path.join(images_path, image_name, 'image_metadata.yml')
+    try:
+        image_info = read_yaml(metadata_file)
+        image_info['image_sha256'] = sha256sum
+        write_yaml(metadata_file, image_info)
+    except Exception as e:
+        print(e)
+
+
+def reflink_supported(directory):
+    # Try to reflink a small file, in the filesystem of directory
+    test_file = os.path.join(directory, '.disklessset_reflink_test')
+    with open(test_file, 'w') as f:
+        f.write('reflink')
+    try:
+        return subprocess.call(['cp', '--reflink=always', test_file, test_file+'.clone'], stderr=subprocess.DEVNULL) == 0
+    finally:
+        for path in [test_file, test_file+'.clone']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def resolve_clone_mode(clone_mode, directory):
+    if clone_mode == 'auto':
+        clone_mode = 'reflink' if reflink_supported(directory) else 'hardlink'
+        print(bcolors.OKBLUE+'[INFO] Using '+clone_mode+' clone mode'+bcolors.ENDC)
+    return clone_mode
+
+
+def clone_tree(source, destination, clone_mode):
+    # reflink: blocks are shared until modified, needs xfs with reflink=1 or btrfs.
+    # hardlink: files are shared, except writable paths which are copied. A
+    #   file of a shared path modified in place is modified for all clones.
+    # copy: full copy.
+    if clone_mode == 'reflink':
+        check_call(['cp', '-a', '--reflink=always', source, destination])
+    elif clone_mode == 'hardlink':
+        check_call(['cp', '-al', source, destination])
+        for path in clone_writable_paths:
+            if os.path.lexists(os.path.join(source, path)):
+                shutil.rmtree(os.path.join(destination, path))
+                check_call(['cp', '-a', '--reflink=auto', os.path.join(source, path), os.path.join(destination, path)])
+    else:
+        check_call(['cp', '-a', source, destination])
+
+
+def run_parallel(function, arguments_list, workers):
+    # Returns the list of arguments whose call failed
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [(arguments, executor.submit(function, *arguments)) for arguments in arguments_list]
+        for arguments, future in futures:
+            try:
+                future.result()
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(bcolors.FAIL+'[ERROR] '+str(e)+bcolors.ENDC)
+                failed.append(arguments)
+    return failed
+
+
+def copy_sparse(source, destination):
+    # Holes are kept, and blocks shared when the filesystem supports reflinks
+    check_call(['cp', '-a', '--sparse=always', '--reflink=auto', source, destination])
+
+
+def mount_livenet_image(image_file, mount_point, selinux):
+    if selinux:
+        os.system('mount -o defcontext="system_u:object_r:default_t:s0",loop ' + image_file + ' ' + mount_point)
+    else:
+        os.system('mount -o loop ' + image_file + ' ' + mount_point)
+
+
+def repositories_hash():
+    # Hash of enabled repositories revisions, so that a layer is not reused
+    # once repositories were updated. None if dnf cannot provide it.
+    try:
+        output = subprocess.check_output(['dnf', '-q', 'repoinfo', '--enabled', '--setopt=module_platform_id=platform:el8'],
+                                         universal_newlines=True, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    lines = [line for line in output.splitlines() if line.split(':')[0].strip() in ['Repo-id', 'Repo-revision', 'Repo-updated', 'Repo-pkgs', 'Repo-baseurl']]
+    if not lines:
+        return None
+    return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+
+def livenet_layer_key(profile, packages, selinux):
+    repositories = repositories_hash()
+    if repositories is None:
+        print(bcolors.WARNING+'[WARNING] Cannot get repositories revisions, layer cache disabled.'+bcolors.ENDC)
+        return None
+    key = {'version': 1, 'profile': profile, 'packages': sorted(packages.split()), 'selinux': selinux, 'repositories': repositories}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def restore_layer(layer_file, image_file, size):
+    # Cached layer can be grown to requested size, not shrunk
+    if not os.path.exists(layer_file) or os.path.getsize(layer_file) > size * 1024 * 1024:
+        return False
+    print(bcolors.OKBLUE+'[INFO] Reusing cached system layer '+os.path.dirname(layer_file)+bcolors.ENDC)
+    copy_sparse(layer_file, image_file)
+    with open(image_file, 'r+b') as f:
+        f.truncate(size * 1024 * 1024)
+    # Images restored from the same layer would share its filesystem UUID,
+    # and could not be mounted at the same time
+    check_call(['xfs_admin', '-U', 'generate', image_file], stdout=subprocess.DEVNULL)
+    return True
+
+
+def save_layer(image_file, layer_file):
+    print(bcolors.OKBLUE+'[INFO] Saving system layer into cache '+os.path.dirname(layer_file)+bcolors.ENDC)
+    os.makedirs(os.path.dirname(layer_file), exist_ok=True)
+    # Concurrent builds can save the same layer
+    fd, tmp_layer_file = tempfile.mkstemp(dir=os.path.dirname(layer_file), suffix='.tmp')
+    os.close(fd)
+    try:
+        copy_sparse(image_file, tmp_layer_file)
+        os.replace(tmp_layer_file, layer_file)
+    except BaseException:
+        if os.path.exists(tmp_layer_file):
+            os.remove(tmp_layer_file)
+        raise
+
+
+def squashfs_stat(squashfs_file):
+    stat = os.stat(squashfs_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def drop_unsquashed(image_name):
+    # Cached content is not valid anymore once image was squashed again
+    image_cache = os.path.join(cache_path, 'unsquashed', image_name)
+    if os.path.exists(image_cache):
+        shutil.rmtree(image_cache)
+
+
+def store_unsquashed(image_name, sha256sum, directory):
+    # Keep the content of the last squashed image, so that next unsquash is
+    # a copy (instant with reflinks) instead of a decompression.
+    # Copied and not moved, as a move across filesystems would not keep
+    # holes of the sparse livenet rootfs.img
+    print(bcolors.OKBLUE+'[INFO] Saving unsquashed image into cache'+bcolors.ENDC)
+    image_cache = os.path.join(cache_path, 'unsquashed', image_name)
+    drop_unsquashed(image_name)
+    os.makedirs(image_cache)
+    copy_sparse(directory, os.path.join(image_cache, 'squashfs-root'))
+    write_yaml(os.path.join(image_cache, 'squashfs.yml'),
+               {'sha256': sha256sum, 'stat': squashfs_stat(os.path.join(images_path, image_name, 'squashfs.img'))})
+
+
+def cached_unsquashed(image_name):
+    # Cached content, if image was not modified since it was cached
+    image_cache = os.path.join(cache_path, 'unsquashed', image_name)
+    try:
+        with open(os.path.join(image_cache, 'squashfs.yml'), 'r') as f:
+            cache_info = yaml.safe_load(f)
+        image_info = read_yaml(os.path.join(images_path, image_name, 'image_metadata.yml'))
+        if cache_info['sha256'] == image_info.get('image_sha256') and cache_info['stat'] == squashfs_stat(os.path.join(images_path, image_name, 'squashfs.img')):
+            return os.path.join(image_cache, 'squashfs-root')
+    except (OSError, KeyError, TypeError, yaml.YAMLError):
+        pass
+    return None
+
+
 def select_from_list(list_from, list_name, index_modifier=-1):
     print('\nSelect ' + list_name + ':')
     if list_from[0] is not None and len(list_from) != 0:
@@ -154,6 +356,46 @@ echo +----------------------------------------------------+
 
 sleep 4
 
+boot
+'''.format(image_name=image_name, image_kernel=image_kernel, image_initramfs=image_initramfs, selinux=int(selinux))
+        return boot_file_content
+    elif image_type == 'nfs_overlay':
+        boot_file_content = '''#!ipxe
+
+echo |
+echo | Entering diskless/images/{image_name}/boot.ipxe
+echo |
+
+set image-kernel {image_kernel}
+set image-initramfs {image_initramfs}
+
+echo | Now starting overlay nfs image boot.
+echo |
+echo | Parameters used:
+echo | > Image target: {image_name}
+echo | > Image type: nfs golden read-only, with tmpfs overlay
+echo | > Console: ${{eq-console}}
+echo | > Additional kernel parameters: ${{eq-kernel-parameters}} ${{dedicated-kernel-parameters}}
+echo |
+echo | Loading linux ...
+
+kernel http://${{next-server}}/preboot_execution_environment/diskless/kernels/${{image-kernel}} initrd=${{image-initramfs}} selinux={selinux} text=1 root=nfs:${{next-server}}:/diskless/images/{image_name}/golden,vers=4.2,ro rw rd.bluebanquise.overlay=tmpfs ${{eq-console}} ${{eq-kernel-parameters}} ${{dedicated-kernel-parameters}} rd.net.timeout.carrier=30 rd.net.timeout.ifup=60 rd.net.dhcp.retry=4
+
+echo | Loading initial ramdisk ...
+
+initrd http://${{next-server}}/preboot_execution_environment/diskless/kernels/${{image-initramfs}}
+
+echo | ALL DONE! We are ready.
+echo | Downloaded images report:
+
+imgstat
+
+echo | Booting in 4s ...
+echo |
+echo +----------------------------------------------------+
+
+sleep 4
+
 boot
 '''.format(image_name=image_name, image_kernel=image_kernel, image_initramfs=image_initramfs, selinux=int(selinux))
         return boot_file_content
@@ -198,25 +440,186 @@ boot
         return boot_file_content
 
 
-# Get arguments passed
-parser = ArgumentParser()
-passed_arguments = parser.parse_args()
+def build_nfs_image(image_name, kernel, password_hash):
+    # Staging NFS image, returns image metadata
+    print(bcolors.OKBLUE + '[INFO] Cleaning and creating image folders.' + bcolors.ENDC)
+    try:
+        # Folders do not exist on first build
+        shutil.rmtree(os.path.join('/diskless/images/', image_name), ignore_errors=True)
+        os.makedirs(os.path.join('/diskless/images/', image_name, 'staging'))
+        shutil.rmtree(os.path.join(images_path, image_name), ignore_errors=True)
+        os.mkdir(os.path.join(images_path, image_name))
+    except OSError as e:
+        print(bcolors.FAIL + '[ERROR] Cannot clean or create image folders: ' + str(e) + bcolors.ENDC)
+
+    print(bcolors.OKBLUE+'[INFO] Generating new ipxe boot file.'+bcolors.ENDC)
+    boot_file_content = generate_ipxe_boot_file('nfs_staging', image_name, kernel, 'initramfs-kernel-' + kernel.strip('vmlinuz-'))
+    with open(os.path.join(images_path, image_name, 'boot.ipxe'), "w") as ff:
+        ff.write(boot_file_content)
+
+    print(bcolors.OKBLUE+'[INFO] Installing new system image... May take some time.'+bcolors.ENDC)
+    os.system('dnf groupinstall -y "core" --setopt=module_platform_id=platform:el8 --installroot=/diskless/images/'+image_name+'/staging')
+
+    print(bcolors.OKBLUE+'[INFO] Setting password into image.'+bcolors.ENDC)
+    with open('/diskless/images/'+image_name+'/staging/etc/shadow') as ff:
+        newText = ff.read().replace('root:*', 'root:'+password_hash)
+    with open('/diskless/images/'+image_name+'/staging/etc/shadow', "w") as ff:
+        ff.write(newText)
+
+    print(bcolors.OKBLUE+'[INFO] Registering new image.'+bcolors.ENDC)
+
+    metadata = dict()
+    metadata['image_name'] = image_name
+    metadata['image_kernel'] = kernel
+    metadata['image_creation_date'] = datetime.today().strftime('%Y-%m-%d')
+    metadata['image_type'] = 'nfs'
+    metadata['image_status'] = 'staging'
+    try:
+        write_yaml(os.path.join(images_path, image_name, 'image_metadata.yml'), metadata)
+    except Exception as e:
+        print(e)
+    print(bcolors.OKGREEN+'\n[OK] Done creating image.'+bcolors.ENDC)
+    return metadata
 
-dnf_cache_directory = '/root/dnf'  # '/dev/shm/'
-image_working_directory_base = '/var/tmp/diskless/workdir/'
-kernels_path = '/var/www/html/preboot_execution_environment/diskless/kernels/'
-images_path = '/var/www/html/preboot_execution_environment/diskless/images/'
 
-print('BlueBanquise Diskless manager')
-print(' 1 - List available kernels')
-print(' 2 - Generate a new initramfs')
-print(' 3 - Generate a new diskless image')
-print(' 4 - Manage existing diskless images')
+def build_livenet_image(image_name, kernel, password_hash, profile, packages, size, ssh_pub_key, selinux, options):
+    # Profile is '1' (standard) to '4' (custom, with additional packages),
+    # size is in MiB. Returns image metadata.
+    image_working_directory = os.path.join(image_working_directory_base, image_name)
+    try:
+        os.makedirs(image_working_directory)
+    except FileExistsError:
+        print(bcolors.WARNING + '[WARNING] The directory ' + image_working_directory + ' already exists. Cleaning.' + bcolors.ENDC)
+        os.system('umount ' + os.path.join(image_working_directory, 'LiveOS/rootfs.img'))
+        shutil.rmtree(image_working_directory)
+        os.makedirs(image_working_directory)
+    except OSError:
+        print(bcolors.FAIL + '[ERROR] Cannot create directory ' + image_working_directory + bcolors.ENDC)
+
+    installroot = os.path.join(image_working_directory, 'mnt')
+    try:
+        os.mkdir(installroot)
+    except OSError:
+        print(bcolors.FAIL + '[ERROR] Cannot create directory ' + installroot + bcolors.ENDC)
 
-main_action = str(input('-->: ').lower().strip())
+    print(bcolors.OKBLUE+'[INFO] Cleaning and creating image folders.'+bcolors.ENDC)
+    try:
+        os.mkdir(os.path.join(images_path, image_name))
+    except FileExistsError:
+        print(bcolors.WARNING + '[WARNING] The directory ' + os.path.join(images_path, image_name) + ' already exists. Cleaning.' + bcolors.ENDC)
+        shutil.rmtree(os.path.join(images_path, image_name))
+        os.mkdir(os.path.join(images_path, image_name))
+    except OSError:
+        print(bcolors.FAIL + '[ERROR] Cannot clean or create image folder ' + os.path.join(images_path, image_name) + bcolors.ENDC)
+
+    print(bcolors.OKBLUE + '[INFO] Generating new ipxe boot file.' + bcolors.ENDC)
+    boot_file_content = generate_ipxe_boot_file('livenet', image_name, kernel, 'initramfs-kernel-' + kernel.strip('vmlinuz-'), selinux)
+    with open(os.path.join(images_path, image_name, 'boot.ipxe'), "w") as ff:
+        ff.write(boot_file_content)
+
+    rootfs_image = os.path.join(image_working_directory, 'LiveOS/rootfs.img')
+    os.mkdir(os.path.join(image_working_directory, 'LiveOS'))
+    layer_file = None
+    if not options.no_cache:
+        layer_key = livenet_layer_key(profile, packages if profile == '4' else '', selinux)
+        if layer_key is not None:
+            layer_file = os.path.join(cache_path, 'layers', layer_key, 'rootfs.img')
+    layer_reused = layer_file is not None and restore_layer(layer_file, rootfs_image, size)
+    if not layer_reused:
+        print(bcolors.OKBLUE + '[INFO] Creating empty image file, format and mount it.' + bcolors.ENDC)
+        create_sparse_image(rootfs_image, size)
+    mount_livenet_image(rootfs_image, installroot, selinux)
+
+    if layer_reused:
+        # Filesystem may have been grown to requested size
+        subprocess.call(['xfs_growfs', installroot], stdout=subprocess.DEVNULL)
+    else:
+        print(bcolors.OKBLUE+'[INFO] Installing system into image.'+bcolors.ENDC)
+        install_status = 0
+        if profile == '3':
+            install_status += os.system('dnf install -y iproute procps-ng openssh-server  --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
+        elif profile == '2':
+            install_status += os.system('dnf install -y iproute procps-ng openssh-server NetworkManager  --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
+            install_status += os.system('dnf install -y dnf yum --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
+        elif profile == '1':
+            install_status += os.system('dnf groupinstall -y "core"  --setopt=module_platform_id=platform:el8 --installroot={0}'.format(installroot))
+        elif profile == '4':
+            try:
+                if os.system('dnf install -y @core {0} --setopt=module_platform_id=platform:el8 --installroot={1}'.format(packages, installroot)) != 0:
+                    raise Exception('dnf install failed')
+            except Exception as e:
+                print(bcolors.FAIL+'[ERROR] '+str(e)+': a package was not found or the repositories are broken.'+bcolors.ENDC)
+                exit(1)
+        # Layer is not cached if a dnf command failed
+        if layer_file is not None and install_status == 0:
+            os.system('umount ' + installroot)
+            save_layer(rootfs_image, layer_file)
+            mount_livenet_image(rootfs_image, installroot, selinux)
+
+    print(bcolors.OKBLUE+'[INFO] Setting password into image.'+bcolors.ENDC)
+    with open(os.path.join(installroot, 'etc/shadow'), "r+") as ff:
+        newText = ff.read().replace('root:*', 'root:'+password_hash)
+        ff.seek(0)
+        ff.write(newText)
+
+    if ssh_pub_key:
+        print(bcolors.OKBLUE+'[INFO] Injecting SSH public key into image.'+bcolors.ENDC)
+        os.mkdir(os.path.join(installroot, 'root/.ssh'))
+        shutil.copyfile(ssh_pub_key, os.path.join(installroot, 'root/.ssh/authorized_keys'))
+
+    print(bcolors.OKBLUE+'[INFO] Setting image information.'+bcolors.ENDC)
+    with open(os.path.join(installroot, 'etc/os-release'), 'a') as ff:
+        ff.writelines(['BLUEBANQUISE_IMAGE_NAME="{0}"\n'.format(image_name),
+                       'BLUEBANQUISE_IMAGE_KERNEL="{0}"\n'.format(kernel),
+                       'BLUEBANQUISE_IMAGE_DATE="{0}"\n'.format(datetime.today().strftime('%Y-%m-%d'))])
+
+    if selinux:
+        print(bcolors.OKBLUE+'[INFO] Enabling SELinux.'+bcolors.ENDC)
+        os.system('dnf install -y libselinux-utils policycoreutils selinux-policy-targeted --installroot={0} --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
+        check_call('mount --bind /proc '+os.path.join(installroot, 'proc'), shell=True)
+        check_call('mount --bind /sys '+os.path.join(installroot, 'sys'), shell=True)
+        check_call('mount --bind /sys/fs/selinux '+os.path.join(installroot, 'sys/fs/selinux'), shell=True)
+        real_root = os.open("/", os.O_RDONLY)
+        os.chroot(installroot)
+        os.chdir("/")
+
+        check_call('restorecon -Rv /', shell=True)
+
+        os.fchdir(real_root)
+        os.chroot(".")
+        os.close(real_root)
+        check_call('umount ' + installroot + '/{sys/fs/selinux,sys,proc}', shell=True)
+
+    print(bcolors.OKBLUE+'[INFO] Packaging and cleaning files... May take some time.'+bcolors.ENDC)
+    os.system('umount ' + installroot)
+    os.rmdir(installroot)
+    sha256sum = squash_image(image_working_directory, os.path.join(images_path, image_name, 'squashfs.img'),
+                             options.squashfs_compression, options.squashfs_processors)
+    if options.cache_unsquashed and not options.no_cache:
+        store_unsquashed(image_name, sha256sum, image_working_directory)
+    else:
+        drop_unsquashed(image_name)
+    shutil.rmtree(image_working_directory)
+
+    print(bcolors.OKBLUE+'[INFO] Registering new image.'+bcolors.ENDC)
+    metadata = dict()
+    metadata['image_name'] = image_name
+    metadata['image_kernel'] = kernel
+    metadata['image_creation_date'] = datetime.today().strftime('%Y-%m-%d')
+    metadata['image_creation_timestamp'] = int(datetime.now().timestamp())
+    metadata['image_selinux_enabled'] = selinux
+    metadata['image_sha256'] = sha256sum
+    metadata['image_size'] = size  # Size unit: MiB
+    metadata['image_type'] = 'livenet'
+    try:
+        write_yaml(os.path.join(images_path, image_name, 'image_metadata.yml'), metadata)
+    except Exception as e:
+        print(e)
+    print(bcolors.OKGREEN+'\n[OK] Done creating image.'+bcolors.ENDC)
+    return metadata
 
-if main_action == '1':
 
+def print_kernels():
     kernel_list = load_kernel_list(kernels_path)
 
     print('')
@@ -236,20 +639,418 @@ if main_action == '1':
     else:
         print(bcolors.WARNING+'[WARNING] No kernel found!'+bcolors.ENDC)
 
+
+def directory_sha256(directory):
+    # Hash of files names and content, None if directory does not exist
+    if not os.path.isdir(directory):
+        return None
+    sha256 = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(directory)):
+        dirs.sort()
+        for filename in sorted(files):
+            sha256.update(os.path.relpath(os.path.join(root, filename), directory).encode())
+            sha256.update(file_sha256(os.path.join(root, filename)).encode())
+    return sha256.hexdigest()
+
+
+def initramfs_key(kernel, compression):
+    # Initramfs only changes if one of these inputs changes
+    try:
+        dracut_version = subprocess.check_output(['dracut', '--version'], universal_newlines=True, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        dracut_version = None
+    key = {'version': 1, 'kernel': kernel, 'kernel_sha256': file_sha256(os.path.join(kernels_path, kernel)),
+           'modules': dracut_modules, 'add': dracut_add_modules, 'drivers': dracut_drivers, 'compression': compression,
+           'dracut': dracut_version, 'bluebanquise_overlay': directory_sha256(dracut_overlay_module_path)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def dracut_supports(compression):
+    # zstd is not supported by older dracut, like 049 of EL8. If dracut
+    # cannot tell, generation will report the error.
+    try:
+        dracut_help = subprocess.run(['dracut', '--help'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    except OSError:
+        return True
+    return '--' + compression in dracut_help
+
+
+def prune_initramfs_cache(kernels):
+    # Cache is organized per kernel version: entries of kernels no longer
+    # available are removed, and only the most recently used entries of
+    # each kernel are kept.
+    initramfs_cache = os.path.join(cache_path, 'initramfs')
+    if not os.path.isdir(initramfs_cache):
+        return
+    kernel_versions = [kernel.strip('vmlinuz-') for kernel in kernels]
+    for entry in os.listdir(initramfs_cache):
+        entry_path = os.path.join(initramfs_cache, entry)
+        if not os.path.isdir(entry_path):
+            os.remove(entry_path)
+        elif entry not in kernel_versions:
+            print(bcolors.OKBLUE+'[INFO] Removing cached initramfs of kernel '+entry+', not available anymore'+bcolors.ENDC)
+            shutil.rmtree(entry_path)
+        else:
+            cached_files = sorted((os.path.join(entry_path, f) for f in os.listdir(entry_path) if f.endswith('.img')),
+                                  key=os.path.getmtime, reverse=True)
+            for cached_file in cached_files[initramfs_cache_per_kernel:]:
+                os.remove(cached_file)
+
+
+def install_initramfs(source, initramfs_file):
+    # Replaced atomically, nodes may be downloading it
+    shutil.copyfile(source, initramfs_file + '.tmp')
+    os.chmod(initramfs_file + '.tmp', 0o644)
+    os.replace(initramfs_file + '.tmp', initramfs_file)
+
+
+def generate_initramfs(kernel, compression, use_cache=True, log_file=None):
+    # Raises CalledProcessError if dracut fails. dracut output goes to
+    # log_file if set, so that parallel generations are not mixed.
+    kernel_version = kernel.strip('vmlinuz-')
+    initramfs_file = os.path.join(kernels_path, 'initramfs-kernel-' + kernel_version)
+    cached_file = None
+    if use_cache:
+        cached_file = os.path.join(cache_path, 'initramfs', kernel_version, initramfs_key(kernel, compression) + '.img')
+        if os.path.exists(cached_file):
+            print(bcolors.OKBLUE+'[INFO] Reusing cached initramfs of kernel '+kernel_version+bcolors.ENDC)
+            # Most recently used entries are kept when pruning
+            os.utime(cached_file)
+            install_initramfs(cached_file, initramfs_file)
+            return
+        os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+
+    print(bcolors.OKBLUE+'[INFO] Now generating initramfs of kernel '+kernel_version+'... May take some time.'+bcolors.ENDC)
+    output_file = (cached_file or initramfs_file) + '.dracut'
+    command = ['dracut', '--' + compression, '-m', dracut_modules, '--add', dracut_add_modules, '--add-drivers', dracut_drivers,
+               '--no-hostonly', '--nolvmconf', '--force', '--kver', kernel_version, output_file]
+    try:
+        if log_file is None:
+            check_call(command[:1] + ['-v'] + command[1:])
+        else:
+            with open(log_file, 'w') as log:
+                check_call(command, stdout=log, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        print(bcolors.FAIL+'[ERROR] Cannot generate initramfs of kernel '+kernel_version+(', see '+log_file if log_file else '')+bcolors.ENDC)
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    if cached_file is not None:
+        os.replace(output_file, cached_file)
+        install_initramfs(cached_file, initramfs_file)
+    else:
+        os.chmod(output_file, 0o644)
+        os.replace(output_file, initramfs_file)
+
+
+def prepare_initramfs(kernels, options):
+    # Returns True if all initramfs are ready
+    if not dracut_supports(options.initramfs_compression):
+        print(bcolors.FAIL+'[ERROR] Installed dracut does not support '+options.initramfs_compression+' compression, use xz, gzip or lz4.'+bcolors.ENDC)
+        return False
+    if len(kernels) == 1:
+        log_files = [None]
+    else:
+        # Kernels are prepared in parallel, each one with its own log
+        os.makedirs(logs_path, exist_ok=True)
+        log_files = [os.path.join(logs_path, 'initramfs-kernel-' + kernel.strip('vmlinuz-') + '.log') for kernel in kernels]
+    failed = run_parallel(generate_initramfs, [(kernel, options.initramfs_compression, not options.no_cache, log_file)
+                                               for kernel, log_file in zip(kernels, log_files)], options.initramfs_jobs)
+    if not options.no_cache:
+        prune_initramfs_cache(load_kernel_list(kernels_path))
+    if failed:
+        return False
+    print(bcolors.OKGREEN+'\n[OK] Done.'+bcolors.ENDC)
+    return True
+
+
+def print_images():
+    for image in os.listdir(images_path):
+        if os.path.exists(os.path.join(images_path, str(image), 'image_metadata.yml')):
+            image_info = read_yaml(os.path.join(images_path, str(image), 'image_metadata.yml'))
+            print('')
+            print('  Image name: '+str(image))
+            print('    ├── Kernel linked: '+str(image_info['image_kernel']))
+            print('    ├── Image type: '+str(image_info['image_type']))
+            if str(image_info['image_type']) == 'nfs':
+                print('    ├── image status: '+str(image_info['image_status']))
+                if image_info.get('image_nfs_mode') == 'overlay':
+                    print('    ├── image nfs mode: overlay')
+            print('    └── Image creation date: '+str(image_info['image_creation_date']))
+        else:
+            print(bcolors.WARNING + '[WARNING] The image \'' + image + '\' is incomplete.' + bcolors.ENDC)
+
+
+def remove_image(image_name):
+    shutil.rmtree(os.path.join(images_path, image_name))
+    shutil.rmtree(os.path.join(cache_path, 'unsquashed', image_name), ignore_errors=True)
+    print("Image "+image_name+" has been deleted.")
+
+
+def parse_size(size):
+    # Image size, as 5120M or 5G, in MiB
+    size = str(size).strip()
+    if size[-1:] == 'G':
+        return int(size[:-1])*1024
+    elif size[-1:] == 'M':
+        return int(size[:-1])
+    raise ValueError('invalid size ' + size + ', supported units are M and G')
+
+
+def load_images_spec(spec_file):
+    # Images to build, with optional defaults shared by all images:
+    #
+    # defaults:
+    #   kernel: vmlinuz-4.18.0-193.6.3.el8_2.x86_64
+    #   password_hash: $6$...
+    # images:
+    #   - name: compute
+    #     type: livenet
+    #     profile: minimal
+    #     size: 5G
+    #
+    # Everything is checked before building anything, so that a typo does not
+    # show up after hours of builds.
+    spec = read_yaml(spec_file)
+    if not isinstance(spec, dict) or not isinstance(spec.get('images'), list) or not spec['images']:
+        raise ValueError(spec_file + ' must contain a non empty images list')
+    defaults = spec.get('defaults') or {}
+    kernel_list = load_kernel_list(kernels_path)
+    images = []
+    for entry in spec['images']:
+        image = dict(defaults)
+        image.update(entry)
+        name = str(image.get('name', ''))
+        if not re.match(r'^[\w.-]+$', name):
+            raise ValueError('invalid image name \'' + name + '\'')
+        if name in [i['name'] for i in images]:
+            raise ValueError('image ' + name + ' is defined twice')
+        unknown = set(image) - set(IMAGE_SPEC_KEYS)
+        if unknown:
+            raise ValueError('image ' + name + ': unknown keys ' + ', '.join(sorted(unknown)))
+        if image.get('type') not in ['nfs', 'livenet']:
+            raise ValueError('image ' + name + ': type must be nfs or livenet')
+        if image.get('kernel') not in kernel_list:
+            raise ValueError('image ' + name + ': kernel ' + str(image.get('kernel')) + ' not found in ' + kernels_path)
+        if 'password_hash' in image:
+            image['password_hash'] = str(image['password_hash'])
+        elif 'password' in image:
+            image['password_hash'] = crypt.crypt(str(image.pop('password')), crypt.METHOD_SHA512)
+        else:
+            raise ValueError('image ' + name + ': password or password_hash is needed')
+        if image['type'] == 'livenet':
+            profile = str(image.get('profile', 'standard'))
+            if profile not in LIVENET_PROFILES:
+                raise ValueError('image ' + name + ': profile must be one of ' + ', '.join(LIVENET_PROFILES))
+            image['profile'] = LIVENET_PROFILES[profile]
+            packages = image.get('packages') or []
+            if isinstance(packages, str):
+                packages = packages.split()
+            if packages and profile != 'custom':
+                raise ValueError('image ' + name + ': packages are only allowed with custom profile')
+            image['packages'] = ' '.join(str(package) for package in packages)
+            image['size'] = parse_size(image.get('size', '5G'))
+            image['selinux'] = bool(image.get('selinux', False))
+            image['ssh_pub_key'] = image.get('ssh_pub_key') or ''
+            if image['ssh_pub_key'] and not os.path.exists(image['ssh_pub_key']):
+                raise ValueError('image ' + name + ': SSH public key not found: ' + image['ssh_pub_key'])
+        images.append(image)
+    return images
+
+
+def build_image_from_spec(image, options, log_file):
+    # Runs in a dedicated process: image builds chroot and change working
+    # directory, and all output of the build and its commands goes to
+    # log_file instead of being mixed with other builds.
+    result = {'name': image['name'], 'type': image['type'], 'kernel': image['kernel'], 'log': log_file}
+    begin = time.monotonic()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    try:
+        with open(log_file, 'w') as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        if image['type'] == 'nfs':
+            metadata = build_nfs_image(image['name'], image['kernel'], image['password_hash'])
+        else:
+            metadata = build_livenet_image(image['name'], image['kernel'], image['password_hash'], image['profile'], image['packages'],
+                                           image['size'], image['ssh_pub_key'], image['selinux'], options)
+        result['status'] = 'success'
+        if metadata.get('image_sha256'):
+            result['sha256'] = metadata['image_sha256']
+    except BaseException as e:
+        # SystemExit included, some build steps exit on failure
+        print(bcolors.FAIL+'[ERROR] Image '+image['name']+' build failed: '+repr(e)+bcolors.ENDC)
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+    result['duration_seconds'] = round(time.monotonic() - begin, 1)
+    return result
+
+
+def build_images(images, options):
+    os.makedirs(options.log_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, options.jobs)) as executor:
+        futures = []
+        for image in images:
+            log_file = os.path.join(options.log_dir, image['name'] + '.log')
+            print(bcolors.OKBLUE+'[INFO] Building image '+image['name']+', logs in '+log_file+bcolors.ENDC)
+            futures.append(executor.submit(build_image_from_spec, image, options, log_file))
+        for image, future in zip(images, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # Worker process died
+                result = {'name': image['name'], 'type': image['type'], 'kernel': image['kernel'], 'status': 'failed', 'error': repr(e)}
+            if result['status'] == 'success':
+                print(bcolors.OKGREEN+'[OK] Image '+result['name']+' built in '+str(result['duration_seconds'])+'s.'+bcolors.ENDC)
+            else:
+                print(bcolors.FAIL+'[ERROR] Image '+result['name']+' failed: '+result['error']+bcolors.ENDC)
+            results.append(result)
+    return results
+
+
+def run_command(options):
+    # Non interactive mode, returns exit code
+    if options.command == 'kernels':
+        print_kernels()
+    elif options.command == 'images':
+        print_images()
+    elif options.command == 'initramfs':
+        kernel_list = load_kernel_list(kernels_path)
+        kernels = kernel_list if options.all else options.kernels
+        if not kernels:
+            print(bcolors.FAIL+'[ERROR] '+('No kernel found!' if options.all else 'No kernel given, list kernels or use --all.')+bcolors.ENDC)
+            return 1
+        for kernel in kernels:
+            if kernel not in kernel_list:
+                print(bcolors.FAIL+'[ERROR] Kernel '+kernel+' not found!'+bcolors.ENDC)
+                return 1
+        return 0 if prepare_initramfs(kernels, options) else 1
+    elif options.command == 'remove':
+        status = 0
+        for image_name in options.images:
+            if not re.match(r'^[\w.-]+$', image_name) or not os.path.isdir(os.path.join(images_path, image_name)):
+                print(bcolors.FAIL+'[ERROR] Image '+image_name+' not found!'+bcolors.ENDC)
+                status = 1
+                continue
+            remove_image(image_name)
+        return status
+    elif options.command == 'build':
+        try:
+            images = load_images_spec(options.spec)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            print(bcolors.FAIL+'[ERROR] Invalid images spec: '+str(e)+bcolors.ENDC)
+            return 1
+        begin = time.monotonic()
+        results = build_images(images, options)
+        manifest = {
+            'spec': os.path.abspath(options.spec),
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_seconds': round(time.monotonic() - begin, 1),
+            'jobs': options.jobs,
+            'images': results,
+        }
+        if options.manifest:
+            write_yaml(options.manifest, manifest)
+            print(bcolors.OKBLUE+'[INFO] Results written into '+options.manifest+bcolors.ENDC)
+        else:
+            print(yaml.dump(manifest, default_flow_style=False))
+        return 0 if all(result['status'] == 'success' for result in results) else 1
+    return 0
+
+
+# Get arguments passed
+parser = ArgumentParser()
+parser.add_argument("--squashfs-compression", dest="squashfs_compression", default="gzip", choices=["gzip", "xz", "lzo", "lz4", "zstd"],
+                    help="Compression of livenet squashfs images. xz gives smaller images, lz4 and zstd faster generation and decompression.")
+parser.add_argument("--squashfs-processors", dest="squashfs_processors", type=int, default=os.cpu_count(),
+                    help="Number of processors used to generate squashfs images.")
+parser.add_argument("--clone-mode", dest="clone_mode", default="auto", choices=["auto", "reflink", "hardlink", "copy"],
+                    help="How NFS images are cloned. auto uses reflink if supported by the filesystem, else hardlink.")
+parser.add_argument("--clone-workers", dest="clone_workers", type=int, default=min(8, os.cpu_count() or 1),
+                    help="Number of NFS nodes images cloned or removed in parallel.")
+parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                    help="Do not use nor fill livenet system layers, unsquashed images and initramfs cache.")
+parser.add_argument("--cache-unsquashed", dest="cache_unsquashed", action="store_true",
+                    help="Keep a copy of the content of livenet images when squashed, so that next unsquash is a copy. Needs the unsquashed size of each image on disk.")
+parser.add_argument("--initramfs-compression", dest="initramfs_compression", default="xz", choices=["xz", "gzip", "lz4", "zstd"],
+                    help="Compression of initramfs. lz4 and zstd are faster to generate and to decompress at boot, zstd needs kernel 5.9 or later.")
+parser.add_argument("--initramfs-jobs", dest="initramfs_jobs", type=int, default=os.cpu_count() or 1,
+                    help="Number of initramfs generated in parallel.")
+# Without sub command, interactive menus are used
+subparsers = parser.add_subparsers(dest="command", title="non interactive commands")
+subparsers.add_parser("kernels", help="List available kernels.")
+parser_initramfs = subparsers.add_parser("initramfs", help="Generate initramfs of kernels.")
+parser_initramfs.add_argument("kernels", nargs="*", metavar="KERNEL", help="Kernel file name, like vmlinuz-4.18.0-193.el8.x86_64.")
+parser_initramfs.add_argument("--all", action="store_true", help="Generate initramfs of all available kernels.")
+subparsers.add_parser("images", help="List available images.")
+parser_build = subparsers.add_parser("build", help="Build images described in a yaml spec file.")
+parser_build.add_argument("spec", help="Images spec file.")
+parser_build.add_argument("--jobs", type=int, default=1, help="Number of images built concurrently.")
+parser_build.add_argument("--log-dir", dest="log_dir", default="/var/tmp/diskless/logs/", help="Folder of images build logs, one file per image.")
+parser_build.add_argument("--manifest", help="Write build results into this yaml file instead of stdout.")
+parser_remove = subparsers.add_parser("remove", help="Remove images.")
+parser_remove.add_argument("images", nargs="+", metavar="IMAGE", help="Image name.")
+passed_arguments = parser.parse_args()
+
+dnf_cache_directory = '/root/dnf'  # '/dev/shm/'
+image_working_directory_base = '/var/tmp/diskless/workdir/'
+kernels_path = '/var/www/html/preboot_execution_environment/diskless/kernels/'
+images_path = '/var/www/html/preboot_execution_environment/diskless/images/'
+cache_path = '/var/cache/bluebanquise/diskless/'
+logs_path = '/var/tmp/diskless/logs/'
+# Initramfs content, cached initramfs are regenerated if changed
+dracut_modules = 'network base nfs'
+dracut_add_modules = 'ifcfg livenet systemd systemd-initrd dracut-systemd bluebanquise-overlay'
+dracut_drivers = 'xfs overlay'
+dracut_overlay_module_path = '/usr/lib/dracut/modules.d/90bluebanquise-overlay/'
+# Cached initramfs kept per kernel, like one per compression used
+initramfs_cache_per_kernel = 2
+# Paths of golden NFS images copied for each node in hardlink clone mode,
+# relative to image root
+clone_writable_paths = ['etc', 'var', 'root', 'home', 'tmp', 'opt', 'srv']
+# Livenet profiles names, as used in images spec files
+LIVENET_PROFILES = {'standard': '1', 'small': '2', 'minimal': '3', 'custom': '4'}
+IMAGE_SPEC_KEYS = ['name', 'type', 'kernel', 'password', 'password_hash', 'profile', 'size', 'packages', 'selinux', 'ssh_pub_key']
+
+if passed_arguments.command is not None:
+    exit(run_command(passed_arguments))
+
+print('BlueBanquise Diskless manager')
+print(' 1 - List available kernels')
+print(' 2 - Generate a new initramfs')
+print(' 3 - Generate a new diskless image')
+print(' 4 - Manage existing diskless images')
+
+main_action = str(input('-->: ').lower().strip())
+
+if main_action == '1':
+
+    print_kernels()
+
 elif main_action == '2':
 
     kernel_list = load_kernel_list(kernels_path)
 
     if len(kernel_list) > 0:
-        selected_kernel = select_from_list(kernel_list, 'kernel')
+        selected_kernel = select_from_list(kernel_list + ['All kernels'], 'kernel')
     else:
         print(bcolors.FAIL+'[ERROR] No kernel found!'+bcolors.ENDC)
         exit(1)
 
-    print(bcolors.OKBLUE+'[INFO] Now generating initramfs... May take some time.'+bcolors.ENDC)
-    os.system('dracut --xz -v -m "network base nfs" --add "ifcfg livenet systemd systemd-initrd dracut-systemd" --add-drivers xfs --no-hostonly --nolvmconf ' + kernels_path + '/initramfs-kernel-' + (kernel_list[selected_kernel].strip('vmlinuz-')) + ' --force --kver={}'.format(kernel_list[selected_kernel].strip('vmlinuz-')))
-    os.chmod(kernels_path + '/initramfs-kernel-' + (kernel_list[selected_kernel].strip('vmlinuz-')), 0o644)
-    print(bcolors.OKGREEN+'\n[OK] Done.'+bcolors.ENDC)
+    if selected_kernel == len(kernel_list):
+        prepare_initramfs(kernel_list, passed_arguments)
+    else:
+        prepare_initramfs([kernel_list[selected_kernel]], passed_arguments)
 
 elif main_action == '3':
 
@@ -285,42 +1086,7 @@ elif main_action == '3':
         answer = str(input("Confirm ? Enter yes or no: ").lower().strip())
         if answer in ['yes', 'y']:
 
-            print(bcolors.OKBLUE + '[INFO] Cleaning and creating image folders.' + bcolors.ENDC)
-            try:
-                shutil.rmtree(os.path.join('/diskless/images/', selected_image_name))
-                os.makedirs(os.path.join('/diskless/images/', selected_image_name, 'staging'))
-                shutil.rmtree(os.path.join(images_path, selected_image_name))
-                os.mkdir(os.path.join(images_path, selected_image_name))
-            except OSError as e:
-                print(bcolors.FAIL + '[ERROR] Cannot clean or create image folders: ' + str(e) + bcolors.ENDC)
-
-            print(bcolors.OKBLUE+'[INFO] Generating new ipxe boot file.'+bcolors.ENDC)
-            boot_file_content = generate_ipxe_boot_file('nfs_staging', selected_image_name, kernel_list[selected_kernel], 'initramfs-kernel-' + kernel_list[selected_kernel].strip('vmlinuz-'))
-            with open(os.path.join(images_path, selected_image_name, 'boot.ipxe'), "w") as ff:
-                ff.write(boot_file_content)
-
-            print(bcolors.OKBLUE+'[INFO] Installing new system image... May take some time.'+bcolors.ENDC)
-            os.system('dnf groupinstall -y "core" --setopt=module_platform_id=platform:el8 --installroot=/diskless/images/'+selected_image_name+'/staging')
-
-            print(bcolors.OKBLUE+'[INFO] Setting password into image.'+bcolors.ENDC)
-            with open('/diskless/images/'+selected_image_name+'/staging/etc/shadow') as ff:
-                newText = ff.read().replace('root:*', 'root:'+password_hash)
-            with open('/diskless/images/'+selected_image_name+'/staging/etc/shadow', "w") as ff:
-                ff.write(newText)
-
-            print(bcolors.OKBLUE+'[INFO] Registering new image.'+bcolors.ENDC)
-
-            metadata = dict()
-            metadata['image_name'] = selected_image_name
-            metadata['image_kernel'] = kernel_list[selected_kernel]
-            metadata['image_creation_date'] = datetime.today().strftime('%Y-%m-%d')
-            metadata['image_type'] = 'nfs'
-            metadata['image_status'] = 'staging'
-            try:
-                write_yaml(os.path.join(images_path, selected_image_name, 'image_metadata.yml'), metadata)
-            except Exception as e:
-                print(e)
-            print(bcolors.OKGREEN+'\n[OK] Done creating image.'+bcolors.ENDC)
+            build_nfs_image(selected_image_name, kernel_list[selected_kernel], password_hash)
 
     if selected_image_type == 1:  # LIVENET
 
@@ -341,11 +1107,7 @@ elif main_action == '3':
         print('Please choose image size:')
         print('(supported units: M=1024*1024, G=1024*1024*1024)')
         print('(Example: 5120M or 5G)')
-        selected_livenet_size = str(input('-->: ').strip())
-        if selected_livenet_size[-1] == 'G':
-            livenet_size = int(selected_livenet_size[:-1])*1024
-        elif selected_livenet_size[-1] == 'M':
-            livenet_size = int(selected_livenet_size[:-1])
+        livenet_size = parse_size(input('-->: '))
 
         print('Enter path to SSH public key (left empty to disable key injection):')
         selected_ssh_pub_key = str(input('-->: ').strip())
@@ -375,122 +1137,9 @@ elif main_action == '3':
 
         if answer in ['yes', 'y']:
 
-            image_working_directory = os.path.join(image_working_directory_base, selected_image_name)
-            try:
-                os.makedirs(image_working_directory)
-            except FileExistsError:
-                print(bcolors.WARNING + '[WARNING] The directory ' + image_working_directory + ' already exists. Cleaning.' + bcolors.ENDC)
-                os.system('umount ' + os.path.join(image_working_directory, 'LiveOS/rootfs.img'))
-                shutil.rmtree(image_working_directory)
-                os.makedirs(image_working_directory)
-            except OSError:
-                print(bcolors.FAIL + '[ERROR] Cannot create directory ' + image_working_directory + bcolors.ENDC)
-
-            installroot = os.path.join(image_working_directory, 'mnt')
-            try:
-                os.mkdir(installroot)
-            except OSError:
-                print(bcolors.FAIL + '[ERROR] Cannot create directory ' + installroot + bcolors.ENDC)
-
-            print(bcolors.OKBLUE+'[INFO] Cleaning and creating image folders.'+bcolors.ENDC)
-            try:
-                os.mkdir(os.path.join(images_path, selected_image_name))
-            except FileExistsError:
-                print(bcolors.WARNING + '[WARNING] The directory ' + os.path.join(images_path, selected_image_name) + ' already exists. Cleaning.' + bcolors.ENDC)
-                shutil.rmtree(os.path.join(images_path, selected_image_name))
-                os.mkdir(os.path.join(images_path, selected_image_name))
-            except OSError:
-                print(bcolors.FAIL + '[ERROR] Cannot clean or create image folder ' + os.path.join(images_path, selected_image_name) + bcolors.ENDC)
-
-            print(bcolors.OKBLUE + '[INFO] Generating new ipxe boot file.' + bcolors.ENDC)
-            boot_file_content = generate_ipxe_boot_file('livenet', selected_image_name, kernel_list[selected_kernel], 'initramfs-kernel-' + kernel_list[selected_kernel].strip('vmlinuz-'), selinux)
-            with open(os.path.join(images_path, selected_image_name, 'boot.ipxe'), "w") as ff:
-                ff.write(boot_file_content)
-
-            print(bcolors.OKBLUE + '[INFO] Creating empty image file, format and mount it.' + bcolors.ENDC)
-            os.mkdir(os.path.join(image_working_directory, 'LiveOS'))
-            os.system('dd if=/dev/zero of=' + os.path.join(image_working_directory, 'LiveOS/rootfs.img') + ' bs=1M count=' + str(livenet_size))
-            os.system('mkfs.xfs ' + os.path.join(image_working_directory, 'LiveOS/rootfs.img'))
-            if selinux:
-                os.system('mount -o defcontext="system_u:object_r:default_t:s0",loop ' + os.path.join(image_working_directory, 'LiveOS/rootfs.img') + ' ' + installroot)
-            else:
-                os.system('mount -o loop ' + os.path.join(image_working_directory, 'LiveOS/rootfs.img') + ' ' + installroot)
-
-            print(bcolors.OKBLUE+'[INFO] Installing system into image.'+bcolors.ENDC)
-            if selected_livenet_type == '3':
-                os.system('dnf install -y iproute procps-ng openssh-server  --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
-            elif selected_livenet_type == '2':
-                os.system('dnf install -y iproute procps-ng openssh-server NetworkManager  --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
-                os.system('dnf install -y dnf yum --installroot={0} --exclude glibc-all-langpacks --exclude cracklib-dicts --exclude grubby --exclude libxkbcommon --exclude pinentry --exclude python3-unbound --exclude unbound-libs --exclude xkeyboard-config --exclude trousers --exclude diffutils --exclude gnupg2-smime --exclude openssl-pkcs11 --exclude rpm-plugin-systemd-inhibit --exclude shared-mime-info --exclude glibc-langpack-* --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
-            elif selected_livenet_type == '1':
-                os.system('dnf groupinstall -y "core"  --setopt=module_platform_id=platform:el8 --installroot={0}'.format(installroot))
-            elif selected_livenet_type == '4':
-                try:
-                    if os.system('dnf install -y @core {0} --setopt=module_platform_id=platform:el8 --installroot={1}'.format(selected_packages_list, installroot)) != 0:
-                        raise Exception('dnf install failed')
-                except Exception as e:
-                    print(bcolors.FAIL+'[ERROR] '+str(e)+': a package was not found or the repositories are broken.'+bcolors.ENDC)
-                    exit(1)
-
-            print(bcolors.OKBLUE+'[INFO] Setting password into image.'+bcolors.ENDC)
-            with open(os.path.join(installroot, 'etc/shadow'), "r+") as ff:
-                newText = ff.read().replace('root:*', 'root:'+password_hash)
-                ff.seek(0)
-                ff.write(newText)
-
-            if selected_ssh_pub_key:
-                print(bcolors.OKBLUE+'[INFO] Injecting SSH public key into image.'+bcolors.ENDC)
-                os.mkdir(os.path.join(installroot, 'root/.ssh'))
-                shutil.copyfile(selected_ssh_pub_key, os.path.join(installroot, 'root/.ssh/authorized_keys'))
-
-            print(bcolors.OKBLUE+'[INFO] Setting image information.'+bcolors.ENDC)
-            with open(os.path.join(installroot, 'etc/os-release'), 'a') as ff:
-                ff.writelines(['BLUEBANQUISE_IMAGE_NAME="{0}"\n'.format(selected_image_name),
-                               'BLUEBANQUISE_IMAGE_KERNEL="{0}"\n'.format(kernel_list[selected_kernel]),
-                               'BLUEBANQUISE_IMAGE_DATE="{0}"\n'.format(datetime.today().strftime('%Y-%m-%d'))])
-
-            if selinux:
-                print(bcolors.OKBLUE+'[INFO] Enabling SELinux.'+bcolors.ENDC)
-                os.system('dnf install -y libselinux-utils policycoreutils selinux-policy-targeted --installroot={0} --setopt=module_platform_id=platform:el8 --nobest'.format(installroot))
-                check_call('mount --bind /proc '+os.path.join(installroot, 'proc'), shell=True)
-                check_call('mount --bind /sys '+os.path.join(installroot, 'sys'), shell=True)
-                check_call('mount --bind /sys/fs/selinux '+os.path.join(installroot, 'sys/fs/selinux'), shell=True)
-                real_root = os.open("/", os.O_RDONLY)
-                os.chroot(installroot)
-                os.chdir("/")
-
-                check_call('restorecon -Rv /', shell=True)
-
-                os.fchdir(real_root)
-                os.chroot(".")
-                os.close(real_root)
-                check_call('umount ' + installroot + '/{sys/fs/selinux,sys,proc}', shell=True)
-
-            print(bcolors.OKBLUE+'[INFO] Packaging and cleaning files... May take some time.'+bcolors.ENDC)
-            os.system('umount ' + installroot)
-            os.rmdir(installroot)
-            os.system('mksquashfs ' + image_working_directory + ' ' + os.path.join(images_path, selected_image_name, 'squashfs.img'))
-            try:
-                sha256sum = hashlib.sha256(open(os.path.join(images_path, selected_image_name, 'squashfs.img'), 'rb').read()).hexdigest()
-            except Exception as e:
-                print(e)
-            shutil.rmtree(image_working_directory)
-
-            print(bcolors.OKBLUE+'[INFO] Registering new image.'+bcolors.ENDC)
-            metadata = dict()
-            metadata['image_name'] = selected_image_name
-            metadata['image_kernel'] = kernel_list[selected_kernel]
-            metadata['image_creation_date'] = datetime.today().strftime('%Y-%m-%d')
-            metadata['image_creation_timestamp'] = int(datetime.now().timestamp())
-            metadata['image_selinux_enabled'] = selinux
-            metadata['image_sha256'] = sha256sum
-            metadata['image_size'] = livenet_size  # Size unit: MiB
-            metadata['image_type'] = 'livenet'
-            try:
-                write_yaml(os.path.join(images_path, selected_image_name, 'image_metadata.yml'), metadata)
-            except Exception as e:
-                print(e)
-            print(bcolors.OKGREEN+'\n[OK] Done creating image.'+bcolors.ENDC)
+            build_livenet_image(selected_image_name, kernel_list[selected_kernel], password_hash, selected_livenet_type,
+                                selected_packages_list if selected_livenet_type == '4' else '', livenet_size, selected_ssh_pub_key, selinux,
+                                passed_arguments)
 
 elif main_action == '4':
 
@@ -505,18 +1154,7 @@ elif main_action == '4':
     sub_main_action = str(input('-->: ').lower().strip())
 
     if sub_main_action == '1':
-        for image in os.listdir(images_path):
-            if os.path.exists(os.path.join(images_path, str(image), 'image_metadata.yml')):
-                image_info = read_yaml(os.path.join(images_path, str(image), 'image_metadata.yml'))
-                print('')
-                print('  Image name: '+str(image))
-                print('    ├── Kernel linked: '+str(image_info['image_kernel']))
-                print('    ├── Image type: '+str(image_info['image_type']))
-                if str(image_info['image_type']) == 'nfs':
-                    print('    ├── image status: '+str(image_info['image_status']))
-                print('    └── Image creation date: '+str(image_info['image_creation_date']))
-            else:
-                print(bcolors.WARNING + '[WARNING] The image \'' + image + '\' is incomplete.' + bcolors.ENDC)
+        print_images()
 
     elif sub_main_action == '2':
         print('Manage kernels of an image.')
@@ -577,17 +1215,33 @@ elif main_action == '4':
                 print('New golden image name ?')
                 selected_image_name = str(input('-->: ').lower().strip())
 
+                golden_modes = ['clones: a full read-write copy of golden per node, persistent',
+                                'overlay: golden read-only and shared by all nodes, nodes writes in RAM (tmpfs), not persistent']
+                golden_mode = ['clones', 'overlay'][select_from_list(golden_modes, 'golden mode')]
+
                 print(bcolors.OKBLUE+'[INFO] Creating directories.'+bcolors.ENDC)
                 try:
-                    shutil.rmtree(os.path.join(images_path, selected_image_name))
+                    # Folders do not exist for a new golden
+                    shutil.rmtree(os.path.join(images_path, selected_image_name), ignore_errors=True)
                     os.mkdir(os.path.join(images_path, selected_image_name))
-                    shutil.rmtree(os.path.join('/diskless/images/', selected_image_name))
-                    os.makedirs(os.path.join('/diskless/images/', selected_image_name, 'nodes'))
+                    shutil.rmtree(os.path.join('/diskless/images/', selected_image_name), ignore_errors=True)
+                    if golden_mode == 'clones':
+                        os.makedirs(os.path.join('/diskless/images/', selected_image_name, 'nodes'))
+                    else:
+                        os.makedirs(os.path.join('/diskless/images/', selected_image_name))
                 except OSError as e:
                     print(bcolors.FAIL + '[ERROR] Cannot create directories: ' + str(e) + bcolors.ENDC)
+                    exit(1)
 
                 print(bcolors.OKBLUE+'[INFO] Cloning staging image to golden.'+bcolors.ENDC)
-                os.system('cp -a /diskless/images/'+selected_image_name_copy+'/staging /diskless/images/'+selected_image_name+'/golden')
+                # Staging image is still used after, files cannot be shared with hardlinks
+                clone_mode = resolve_clone_mode(passed_arguments.clone_mode, os.path.join('/diskless/images/', selected_image_name))
+                try:
+                    clone_tree('/diskless/images/'+selected_image_name_copy+'/staging', '/diskless/images/'+selected_image_name+'/golden',
+                               'copy' if clone_mode == 'hardlink' else clone_mode)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(bcolors.FAIL + '[ERROR] Cannot clone staging image to golden: ' + str(e) + bcolors.ENDC)
+                    exit(1)
                 print(bcolors.OKBLUE+'[INFO] Generating related files.'+bcolors.ENDC)
 
                 metadata = dict()
@@ -596,14 +1250,18 @@ elif main_action == '4':
                 metadata['image_creation_date'] = datetime.today().strftime('%Y-%m-%d')
                 metadata['image_type'] = 'nfs'
                 metadata['image_status'] = 'golden'
+                metadata['image_nfs_mode'] = golden_mode
                 try:
                     write_yaml(os.path.join(images_path, selected_image_name, 'image_metadata.yml'), metadata)
                 except Exception as e:
                     print(e)
                 print(bcolors.OKBLUE+'[INFO] Generating new ipxe boot file.'+bcolors.ENDC)
-                boot_file_content = generate_ipxe_boot_file('nfs_golden', selected_image_name, image_info['image_kernel'], 'initramfs-kernel-'+image_info['image_kernel'].strip('vmlinuz-'))
-            with open(os.path.join(images_path, selected_image_name, 'boot.ipxe'), "w") as ff:
-                ff.write(boot_file_content)
+                boot_file_content = generate_ipxe_boot_file('nfs_golden' if golden_mode == 'clones' else 'nfs_overlay', selected_image_name,
+                                                            image_info['image_kernel'], 'initramfs-kernel-'+image_info['image_kernel'].strip('vmlinuz-'))
+                with open(os.path.join(images_path, selected_image_name, 'boot.ipxe'), "w") as ff:
+                    ff.write(boot_file_content)
+                if golden_mode == 'overlay':
+                    print(bcolors.OKBLUE+'[INFO] Export /diskless/images/'+selected_image_name+'/golden read-only to nodes, and boot them with the image.'+bcolors.ENDC)
 
     elif sub_main_action == '4':
         print('Please select image to work with')
@@ -619,6 +1277,8 @@ elif main_action == '4':
 
         if image_info['image_type'] != 'nfs':
             print('Error: This is not an NFS image.')
+        elif image_info.get('image_nfs_mode') == 'overlay':
+            print('Image is an overlay golden, shared by all nodes: nodes do not need to be added.')
         elif image_info['image_status'] == 'golden':
 
             print('Manages nodes of image '+selected_image)
@@ -637,16 +1297,21 @@ elif main_action == '4':
                 print('Please enter nodes range to add:')
                 nodes_range = str(input('-->: ').lower().strip())
                 print(bcolors.OKBLUE+'[INFO] Cloning, this may take some time...'+bcolors.ENDC)
-                for node in NodeSet(nodes_range):
-                    print("Working on node: "+str(node))
-                    os.system('cp -a /diskless/images/'+selected_image+'/golden /diskless/images/'+selected_image+'/nodes/'+node)
+                clone_mode = resolve_clone_mode(passed_arguments.clone_mode, os.path.join('/diskless/images/', selected_image, 'nodes'))
+                failed = run_parallel(clone_tree, [('/diskless/images/'+selected_image+'/golden', '/diskless/images/'+selected_image+'/nodes/'+node, clone_mode)
+                                                   for node in NodeSet(nodes_range)], passed_arguments.clone_workers)
+                if failed:
+                    print(bcolors.FAIL+'[ERROR] Could not clone nodes '+str(NodeSet.fromlist([os.path.basename(arguments[1]) for arguments in failed]))+bcolors.ENDC)
+                    exit(1)
+                print(bcolors.OKGREEN+'[OK] '+str(len(NodeSet(nodes_range)))+' node(s) cloned.'+bcolors.ENDC)
             elif sub_sub_main_action == '3':
                 print('Please enter nodes range to remove:')
                 nodes_range = str(input('-->: ').lower().strip())
                 print(bcolors.OKBLUE+'[INFO] Deleting, this may take some time...'+bcolors.ENDC)
-                for node in NodeSet(nodes_range):
-                    print("Working on node: "+str(node))
-                    shutil.rmtree(os.path.join('/diskless/images/', selected_image, 'nodes', node))
+                failed = run_parallel(shutil.rmtree, [(os.path.join('/diskless/images/', selected_image, 'nodes', node),) for node in NodeSet(nodes_range)],
+                                      passed_arguments.clone_workers)
+                if failed:
+                    exit(1)
 
     elif sub_main_action == '5':
         print('Manages livenet images')
@@ -684,12 +1349,17 @@ elif main_action == '4':
                 print(e)
                 raise
 
-            print(bcolors.OKBLUE + '[INFO] Unsquash image' + bcolors.ENDC)
-            try:
-                os.system('unsquashfs -d ' + os.path.join(image_working_directory, 'squashfs-root') + ' ' + os.path.join(images_path, selected_image_name, 'squashfs.img'))
-            except Exception as e:
-                print(e)
-                raise
+            unsquashed = None if passed_arguments.no_cache else cached_unsquashed(selected_image_name)
+            if unsquashed is not None:
+                print(bcolors.OKBLUE + '[INFO] Copying unsquashed image from cache' + bcolors.ENDC)
+                copy_sparse(unsquashed, os.path.join(image_working_directory, 'squashfs-root'))
+            else:
+                print(bcolors.OKBLUE + '[INFO] Unsquash image' + bcolors.ENDC)
+                try:
+                    os.system('unsquashfs -d ' + os.path.join(image_working_directory, 'squashfs-root') + ' ' + os.path.join(images_path, selected_image_name, 'squashfs.img'))
+                except Exception as e:
+                    print(e)
+                    raise
 
             print(bcolors.OKBLUE + '[INFO] Mounting image' + bcolors.ENDC)
             try:
@@ -734,11 +1404,21 @@ elif main_action == '4':
             print(bcolors.OKBLUE + '[INFO] Backing up old image and generating new one.' + bcolors.ENDC)
             print(bcolors.OKBLUE + '[INFO] Backup at /var/www/html/preboot_execution_environment/diskless/images/' + selected_image_name + '/squashfs.img.bkp' + bcolors.ENDC)
             try:
-                os.rename(os.path.join(images_path, selected_image_name, 'squashfs.img'), os.path.join(images_path, selected_image_name, 'squashfs.img.bkp'))
-                os.system('mksquashfs ' + os.path.join(image_working_directory, 'squashfs-root/') + ' ' + os.path.join(images_path, selected_image_name, 'squashfs.img'))
+                # Hard link, so that squashfs.img stays in place for booting
+                # nodes until the new one replaces it
+                if os.path.lexists(os.path.join(images_path, selected_image_name, 'squashfs.img.bkp')):
+                    os.remove(os.path.join(images_path, selected_image_name, 'squashfs.img.bkp'))
+                os.link(os.path.join(images_path, selected_image_name, 'squashfs.img'), os.path.join(images_path, selected_image_name, 'squashfs.img.bkp'))
+                sha256sum = squash_image(os.path.join(image_working_directory, 'squashfs-root/'), os.path.join(images_path, selected_image_name, 'squashfs.img'),
+                                         passed_arguments.squashfs_compression, passed_arguments.squashfs_processors)
             except Exception as e:
                 print(e)
                 raise
+            update_image_sha256(selected_image_name, sha256sum)
+            if passed_arguments.cache_unsquashed and not passed_arguments.no_cache:
+                store_unsquashed(selected_image_name, sha256sum, os.path.join(image_working_directory, 'squashfs-root'))
+            else:
+                drop_unsquashed(selected_image_name)
 
             print(bcolors.OKBLUE + '[INFO] Cleaning backup and working dirs' + bcolors.ENDC)
             try:
@@ -798,8 +1478,7 @@ elif main_action == '4':
 
             print(bcolors.OKBLUE + '[INFO] Generating and mounting new empty image' + bcolors.ENDC)
             try:
-                os.system('dd if=/dev/zero of=/' + image_working_directory + '_copy/squashfs-root/LiveOS/rootfs.img bs=1M count=' + str(livenet_size))
-                os.system('mkfs.xfs ' + image_working_directory + '_copy/squashfs-root/LiveOS/rootfs.img')
+                create_sparse_image(image_working_directory + '_copy/squashfs-root/LiveOS/rootfs.img', livenet_size)
                 os.system('mount ' + image_working_directory + '_copy/squashfs-root/LiveOS/rootfs.img ' + os.path.join(image_working_directory, 'mnt_copy/'))
             except Exception as e:
                 print(e)
@@ -833,11 +1512,12 @@ elif main_action == '4':
 
             print(bcolors.OKBLUE + '[INFO] Removing old squashfs and generating new one...' + bcolors.ENDC)
             try:
-                os.remove(os.path.join(images_path, selected_image_name, 'squashfs.img'))
-                os.system('mksquashfs ' + image_working_directory + '_copy/squashfs-root/ ' + os.path.join(images_path, selected_image_name, 'squashfs.img'))
+                sha256sum = squash_image(image_working_directory + '_copy/squashfs-root/', os.path.join(images_path, selected_image_name, 'squashfs.img'),
+                                         passed_arguments.squashfs_compression, passed_arguments.squashfs_processors)
             except Exception as e:
                 print(e)
                 raise
+            update_image_sha256(selected_image_name, sha256sum)
 
             print(bcolors.OKBLUE + '[INFO] Cleaning' + bcolors.ENDC)
             try:
@@ -863,8 +1543,7 @@ elif main_action == '4':
         selected_image_name = images_list[selected_image]
 
         try:
-            shutil.rmtree(os.path.join(images_path, selected_image_name))
-            print("Image "+selected_image_name+" has been deleted.")
+            remove_image(selected_image_name)
         except Exception as e:
             print(e)
             raise
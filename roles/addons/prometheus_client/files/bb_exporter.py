@@ -12,63 +12,535 @@
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
 import os
+import gzip
+import hashlib
 import importlib.util
+import json
+import logging
+import signal
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 import yaml
 
-from prometheus_client import start_http_server
-from prometheus_client.core import REGISTRY
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily, Metric, REGISTRY
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as CONTENT_TYPE_OPENMETRICS
+from prometheus_client.openmetrics.exposition import generate_latest as generate_latest_openmetrics
 
+# Exporter self instrumentation. Process metrics (RSS, CPU time, open fds,
+# etc.) of the exporter itself are provided by the default REGISTRY.
+COLLECTOR_DURATION = Histogram('bb_exporter_collector_duration_seconds', 'Duration of collectors runs',
+                               ['collector'], buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 120))
+COLLECTOR_ERRORS = Counter('bb_exporter_collector_errors', 'Number of collectors runs that raised an error', ['collector'])
 
-# Colors, from https://stackoverflow.com/questions/287871/how-to-print-colored-text-in-terminal-in-python
-class bcolors:
-    HEADER = '\033[95m'
-    OKBLUE = '\033[94m'
-    OKGREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    ENDC = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
+
+logger = logging.getLogger('bb_exporter')
+
+# Attributes every LogRecord has. Any other attribute was passed by the caller
+# using extra={...}, and is a structured field of the message.
+LOG_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+def log_fields(record):
+    return {key: value for key, value in record.__dict__.items() if key not in LOG_RECORD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    """[LEVEL] logger: message key=value ..."""
+
+    def format(self, record):
+        message = '[' + record.levelname + '] ' + record.name + ': ' + record.getMessage()
+        for key, value in sorted(log_fields(record).items()):
+            message += ' ' + key + '=' + str(value)
+        if record.exc_info:
+            message += '\n' + self.formatException(record.exc_info)
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line, with structured fields as keys."""
+
+    def format(self, record):
+        message = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        message.update(log_fields(record))
+        if record.exc_info:
+            message['exception'] = self.formatException(record.exc_info)
+        return json.dumps(message, default=str)
+
+
+class RepeatFilter(logging.Filter):
+    """Suppress identical messages repeated within repeat_interval seconds.
+
+    When the message is emitted again, the number of suppressed occurrences
+    is added to it as the 'repeated' field. Messages not seen for a while are
+    forgotten, as fields values may change at each message.
+    """
+
+    max_entries = 10000
+
+    def __init__(self, repeat_interval):
+        super(RepeatFilter, self).__init__()
+        self.repeat_interval = repeat_interval
+        self.last_seen = {}
+        self.last_prune = time.monotonic()
+        self.lock = threading.Lock()
+
+    def prune(self, now):
+        # Suppressed occurrences are kept one more interval, to be reported
+        # if the message comes back
+        self.last_seen = {key: (last_time, suppressed) for key, (last_time, suppressed) in self.last_seen.items()
+                          if now - last_time < self.repeat_interval * (2 if suppressed else 1)}
+        if len(self.last_seen) > self.max_entries:
+            self.last_seen = {}
+        self.last_prune = now
+
+    def filter(self, record):
+        # Fields values may not be hashable
+        key = (record.name, record.levelno, record.getMessage(), repr(sorted(log_fields(record).items())))
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_prune > self.repeat_interval or len(self.last_seen) > self.max_entries:
+                self.prune(now)
+            last_time, suppressed = self.last_seen.get(key, (None, 0))
+            if last_time is not None and now - last_time < self.repeat_interval:
+                self.last_seen[key] = (last_time, suppressed + 1)
+                return False
+            self.last_seen[key] = (now, 0)
+        if suppressed:
+            record.repeated = suppressed
+        return True
+
+
+def setup_logging(configuration):
+    # Only state changes and errors are logged by default (info level), per
+    # collection details are debug level.
+    configuration = configuration or {}
+    handler = logging.StreamHandler()
+    if configuration.get('format', 'text') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+    repeat_interval = float(configuration.get('repeat_interval', 300))
+    if repeat_interval > 0:
+        handler.addFilter(RepeatFilter(repeat_interval))
+    root = logging.getLogger()
+    for previous_handler in list(root.handlers):
+        root.removeHandler(previous_handler)
+    root.addHandler(handler)
+    level = str(configuration.get('level', 'info')).upper()
+    if level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+        # A typo in logging configuration must not stop the exporter
+        root.setLevel(logging.INFO)
+        logger.warning('Unknown logging level, using info', extra={'level': configuration.get('level')})
+    else:
+        root.setLevel(level)
+    if configuration.get('format', 'text') not in ['text', 'json']:
+        logger.warning('Unknown logging format, using text', extra={'format': configuration.get('format')})
 
 
 def load_file(filename):
-    print(bcolors.OKBLUE+'[INFO] Loading '+filename+bcolors.ENDC)
+    logger.info('Loading configuration file', extra={'file': filename})
     with open(filename, 'r') as f:
-        # return yaml.load(f, Loader=yaml.FullLoader) ## Waiting for PyYaml 5.1
-        return yaml.load(f)
+        return yaml.safe_load(f)
 
 
-if __name__ == '__main__':
+class CollectorSampler(object):
+    """Run a plugin collector on its own interval and keep its last result."""
+
+    def __init__(self, name, collector, interval, stale_after, timeout):
+        self.name = name
+        self.collector = collector
+        self.interval = interval
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self.snapshot = []
+        self.last_sample_time = None
+        self.next_run = 0.0
+        self.running = False
+        self.started = 0.0
+        self.timed_out = False
+
+    def sample(self):
+        # Metrics are fully materialized here, in a worker thread, so that
+        # scrapes only have to read the snapshot reference.
+        metrics = list(self.collector.collect())
+        self.snapshot = metrics
+        self.last_sample_time = time.time()
+
+    def age(self):
+        if self.last_sample_time is None:
+            return None
+        return time.time() - self.last_sample_time
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or age > self.interval * self.stale_after
+
+    def deadline(self):
+        return self.started + self.timeout
+
+
+class SamplingEngine(object):
+    """Execute plugin samplers concurrently in a worker pool and serve their snapshots.
+
+    The engine itself is registered into the prometheus REGISTRY. In background
+    mode, a scrape never waits for a plugin: it simply returns the last sampled
+    metrics. In scrape mode, all plugins are run concurrently during the scrape,
+    each one bounded by its own timeout.
+    """
+
+    def __init__(self, workers, mode='background'):
+        if mode not in ['background', 'scrape']:
+            raise ValueError('Unknown sampling mode ' + repr(mode) + ', must be background or scrape')
+        self.samplers = []
+        self.mode = mode
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='bb_exporter_sampling')
+        self.thread.daemon = True
+
+    def add(self, sampler):
+        self.samplers.append(sampler)
+
+    def start(self):
+        if self.mode == 'background':
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.pool.shutdown(wait=False)
+        # Plugins owning resources (threads, files) can release them
+        for sampler in self.samplers:
+            if hasattr(sampler.collector, 'close'):
+                try:
+                    sampler.collector.close()
+                except Exception as e:
+                    logger.error('Collector failed to close', extra={'collector': sampler.name, 'error': str(e)})
+
+    def run(self, sampler):
+        try:
+            with COLLECTOR_DURATION.labels(sampler.name).time():
+                sampler.sample()
+        except Exception as e:
+            COLLECTOR_ERRORS.labels(sampler.name).inc()
+            logger.error('Collector failed', extra={'collector': sampler.name, 'error': str(e)})
+        finally:
+            # A run that ended late is still reported as a timeout
+            sampler.timed_out = time.monotonic() > sampler.deadline()
+            sampler.running = False
+
+    def submit(self, sampler, now):
+        sampler.running = True
+        sampler.started = now
+        return self.pool.submit(self.run, sampler)
+
+    def check_timeouts(self, now):
+        for sampler in self.samplers:
+            if sampler.running and not sampler.timed_out and now > sampler.deadline():
+                sampler.timed_out = True
+                logger.warning('Collector exceeded its timeout', extra={'collector': sampler.name, 'timeout': sampler.timeout})
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            self.check_timeouts(now)
+            next_wakeup = now + 1.0
+            for sampler in self.samplers:
+                # Never queue a new run while the previous one is still going,
+                # a hung plugin would otherwise exhaust the pool.
+                if not sampler.running and now >= sampler.next_run:
+                    sampler.next_run = now + sampler.interval
+                    self.submit(sampler, now)
+                next_wakeup = min(next_wakeup, sampler.next_run)
+            self.stop_event.wait(max(next_wakeup - time.monotonic(), 0.05))
+
+    def collect_now(self):
+        # Start all plugins at once, then wait for each one until its own
+        # deadline. Scrape duration is bounded by the slowest timeout, not
+        # by the sum of all plugins durations.
+        now = time.monotonic()
+        futures = []
+        for sampler in self.samplers:
+            if not sampler.running:
+                futures.append((sampler, self.submit(sampler, now)))
+        for sampler, future in sorted(futures, key=lambda item: item[0].deadline()):
+            try:
+                future.result(timeout=max(sampler.deadline() - time.monotonic(), 0))
+            except FutureTimeoutError:
+                pass
+        self.check_timeouts(time.monotonic())
+
+    def collect(self):
+        if self.mode == 'scrape':
+            self.collect_now()
+        gauge_age = GaugeMetricFamily('bb_exporter_collector_sample_age_seconds', 'Age of the last sample of each collector', labels=['collector'])
+        gauge_stale = GaugeMetricFamily('bb_exporter_collector_stale', 'Collector last sample is older than its allowed staleness (1) or fresh (0)', labels=['collector'])
+        gauge_timeout = GaugeMetricFamily('bb_exporter_collector_timeout', 'Collector last run exceeded its timeout (1) or not (0)', labels=['collector'])
+        gauge_last_success = GaugeMetricFamily('bb_exporter_collector_last_success_timestamp', 'Collector last successful run end time, as unix timestamp', labels=['collector'])
+        for sampler in self.samplers:
+            for metric in sampler.snapshot:
+                yield metric
+            age = sampler.age()
+            if age is not None:
+                gauge_age.add_metric([sampler.name], age)
+            gauge_stale.add_metric([sampler.name], float(sampler.is_stale()))
+            gauge_timeout.add_metric([sampler.name], float(sampler.timed_out))
+            if sampler.last_sample_time is not None:
+                gauge_last_success.add_metric([sampler.name], sampler.last_sample_time)
+        yield gauge_age
+        yield gauge_stale
+        yield gauge_timeout
+        yield gauge_last_success
+
+
+class EngineProxy(object):
+    """Registered once into the REGISTRY, forward scrapes to the current engine.
 
-    print('\nStarting BlueBanquise Exporter\n')
+    This allows to replace the engine, and so all collectors, on configuration
+    reload, without touching the REGISTRY or the http server.
+    """
 
-    exporter_configuration = load_file('/etc/bb_exporter/bb_exporter.yml')
+    def __init__(self, engine):
+        self.engine = engine
+
+    def describe(self):
+        # Metrics are dynamic, and may share names with other collectors of
+        # the REGISTRY (see MergedRegistry): registration must not collect
+        # them to look for duplicates.
+        return []
+
+    def collect(self):
+        return self.engine.collect()
+
+
+class MergedRegistry(object):
+    """Expose families of the same name, provided by several collectors, as one.
+
+    An exposition cannot contain a metric name twice, but the same metrics can
+    come from the local exporter and from aggregated targets (process_*,
+    bb_exporter_*, or plugins running on both sides).
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        families = OrderedDict()
+        for family in self.registry.collect():
+            merged = families.get(family.name)
+            if merged is None:
+                families[family.name] = family
+            elif merged.type != family.type:
+                logger.warning('Metric exposed with different types, dropping duplicate', extra={'metric': family.name, 'type': family.type})
+            else:
+                if not getattr(merged, 'merged', False):
+                    # Families are kept in collectors snapshots, never modify them
+                    copy = Metric(merged.name, merged.documentation, merged.type, getattr(merged, 'unit', ''))
+                    copy.samples = list(merged.samples)
+                    copy.merged = True
+                    families[family.name] = merged = copy
+                merged.samples.extend(family.samples)
+        return list(families.values())
+
+
+class ExpositionCache(object):
+    """Serialize the registry at most once per window, and keep the result.
+
+    Both plain and gzip encoded bodies are kept in memory, for each format
+    (Prometheus text and OpenMetrics), so that scrapes arriving within the
+    same window (for example from a pair of HA Prometheus servers) are
+    answered without serializing or compressing again.
+    """
+
+    def __init__(self, registry, window):
+        self.registry = registry
+        self.window = window
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, openmetrics):
+        # Concurrent scrapes wait for the one serializing, then all share its result
+        with self.lock:
+            now = time.monotonic()
+            entry = self.entries.get(openmetrics)
+            if entry is None or now - entry[0] >= self.window:
+                if openmetrics:
+                    body = generate_latest_openmetrics(self.registry)
+                else:
+                    body = generate_latest(self.registry)
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                entry = (now, etag, body, gzip.compress(body, compresslevel=6))
+                self.entries[openmetrics] = entry
+            return entry
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve cached exposition, with gzip, ETag and OpenMetrics negotiation."""
+
+    # Keep-alive, for Prometheus and the aggregator plugin
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately, avoid Nagle delays between them
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        _, etag, body, gzip_body = self.server.cache.get(openmetrics)
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_LATEST)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept, Accept-Encoding')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip_body
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # Cached bytes are handed as is to the socket, without any copy
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('HTTP request', extra={'client': self.client_address[0], 'request': format % args})
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Threaded http server (http.server.ThreadingHTTPServer is python 3.7+)."""
+
+    daemon_threads = True
+
+    def __init__(self, address, port, cache):
+        HTTPServer.__init__(self, (address, port), MetricsHandler)
+        self.cache = cache
+
+
+def start_metrics_server(configuration):
+    # Http parameters are optional, defaults are the historical 9777 port and
+    # a 1 second window, enough to merge scrapes of HA Prometheus servers.
+    configuration = configuration or {}
+    address = str(configuration.get('address', '0.0.0.0'))
+    port = int(configuration.get('port', 9777))
+    cache = ExpositionCache(MergedRegistry(REGISTRY), float(configuration.get('cache_window', 1)))
+    logger.info('Starting http server', extra={'address': address, 'port': port, 'cache_window': cache.window})
+    server = MetricsServer(address, port, cache)
+    thread = threading.Thread(target=server.serve_forever, name='bb_exporter_http')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def load_plugin(plugins_path, name):
+    # Plugins are imported only if configured, and an import error (for
+    # example a missing python module) only disables the faulty plugin.
+    plugin_file = os.path.join(plugins_path, name + '.py')
+    if not os.path.isfile(plugin_file):
+        logger.error('Collector was defined in configuration file but could not be found', extra={'collector': name, 'file': plugin_file})
+        return None
+    try:
+        spec = importlib.util.spec_from_file_location(name, plugin_file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except Exception as e:
+        logger.error('Collector could not be loaded', extra={'collector': name, 'error': repr(e)})
+        return None
+    return module
+
+
+def build_engine(exporter_configuration):
     plugins_path = exporter_configuration['plugins_path']
+    collectors = exporter_configuration.get('collectors') or {}
+
+    # Sampling parameters are optional, defaults keep the historical
+    # behavior of a fresh value for each 15s Prometheus scrape.
+    sampling_configuration = exporter_configuration.get('sampling') or {}
+    default_interval = float(sampling_configuration.get('default_interval', 15))
+    default_timeout = float(sampling_configuration.get('default_timeout', 10))
+    stale_after = float(sampling_configuration.get('stale_after', 3))
+    intervals = sampling_configuration.get('intervals') or {}
+    timeouts = sampling_configuration.get('timeouts') or {}
+    # One worker per collector by default, so that all can run concurrently
+    workers = int(sampling_configuration.get('workers', max(len(collectors), 1)))
+    engine = SamplingEngine(workers, sampling_configuration.get('mode', 'background'))
+
+    for coll in collectors:
+        module = load_plugin(plugins_path, coll)
+        if module is None:
+            continue
+        try:
+            collector = module.Collector(collectors[coll])
+        except Exception as e:
+            logger.error('Collector could not be initialized', extra={'collector': coll, 'error': repr(e)})
+            continue
+        interval = float(intervals.get(coll, default_interval))
+        timeout = float(timeouts.get(coll, default_timeout))
+        logger.info('Registering collector', extra={'collector': coll, 'interval': interval, 'timeout': timeout})
+        engine.add(CollectorSampler(coll, collector, interval, stale_after, timeout))
+    return engine
+
+
+if __name__ == '__main__':
+
+    configuration_file = '/etc/bb_exporter/bb_exporter.yml'
+
+    setup_logging(None)
+    logger.info('Starting BlueBanquise Exporter')
+
+    exporter_configuration = load_file(configuration_file)
+    setup_logging(exporter_configuration.get('logging'))
+
+    server = start_metrics_server(exporter_configuration.get('http'))
+
+    proxy = EngineProxy(build_engine(exporter_configuration))
+    proxy.engine.start()
+    REGISTRY.register(proxy)
 
-    print(bcolors.OKBLUE+'[INFO] Loading plugins'+bcolors.ENDC)
-    modules = {}
-    for f in os.listdir(plugins_path+'/'):
-        if os.path.isfile(plugins_path+'/'+f) and f.endswith('.py') and f != 'main.py' and f[:-3] in exporter_configuration['collectors']:
-            modname = f[:-3]  # remove '.py' extension
-            spec = importlib.util.spec_from_file_location(modname, plugins_path+'/'+f)
-            modules[modname] = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(modules[modname])
-
-    print(bcolors.OKBLUE+'  Found:'+bcolors.ENDC)
-    for plugin in modules:
-        print(bcolors.OKBLUE+'    - '+plugin+bcolors.ENDC)
-
-    print(bcolors.OKBLUE+'[INFO] Starting http server'+bcolors.ENDC)
-    start_http_server(9777)
-
-    print(bcolors.OKBLUE+'[INFO] Registering collector plugins...'+bcolors.ENDC)
-    for coll in exporter_configuration['collectors']:
-        if coll in modules:
-            print(bcolors.OKBLUE+'    - Registering '+coll+bcolors.ENDC)
-            REGISTRY.register(modules[coll].Collector(exporter_configuration['collectors'][coll]))
-        else:
-            print('Collector '+coll+' was defined in configuration file but could not be found.')
+    # On SIGHUP, configuration is reloaded and collectors are registered again,
+    # while http server keeps serving scrapes.
+    reload_event = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
 
     while True:
-        time.sleep(1)
+        if reload_event.wait(1):
+            reload_event.clear()
+            logger.info('Reloading configuration')
+            try:
+                exporter_configuration = load_file(configuration_file)
+                setup_logging(exporter_configuration.get('logging'))
+                # Http server address and port are only read at start
+                server.cache.window = float((exporter_configuration.get('http') or {}).get('cache_window', 1))
+                new_engine = build_engine(exporter_configuration)
+            except Exception as e:
+                logger.error('Configuration reload failed, keeping current one', extra={'error': repr(e)})
+                continue
+            # Keep serving previous samples until new collectors ran once,
+            # to avoid any gap in scrapes.
+            # Plugins keeping state between collections (like nhc background
+            # runner) can take over the one of their previous instance.
+            previous_samplers = {sampler.name: sampler for sampler in proxy.engine.samplers}
+            for sampler in new_engine.samplers:
+                if sampler.name in previous_samplers:
+                    sampler.snapshot = previous_samplers[sampler.name].snapshot
+                    sampler.last_sample_time = previous_samplers[sampler.name].last_sample_time
+                    if hasattr(sampler.collector, 'resume'):
+                        try:
+                            sampler.collector.resume(previous_samplers[sampler.name].collector)
+                        except Exception as e:
+                            logger.error('Collector failed to resume', extra={'collector': sampler.name, 'error': str(e)})
+            new_engine.start()
+            previous_engine = proxy.engine
+            proxy.engine = new_engine
+            previous_engine.stop()
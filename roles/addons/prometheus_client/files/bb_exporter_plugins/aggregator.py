@@ -0,0 +1,146 @@
+# Aggregator plugin for bb exporter
+# Scrape bb_exporter of many nodes (for example all nodes of an iceberg), from
+# a management node, and expose all their metrics in a single endpoint. The
+# central Prometheus then only scrapes one endpoint per iceberg.
+# https://github.com/bluebanquise/bluebanquise - MIT license
+
+import gzip
+import http.client
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+try:
+    from ClusterShell.NodeSet import NodeSet
+except ImportError:
+    NodeSet = None
+
+logger = logging.getLogger('bb_exporter.aggregator')
+
+
+def expand_targets(targets):
+    # Targets can be nodesets (c[001-100]) if ClusterShell is available
+    nodes = []
+    for target in targets:
+        if NodeSet is not None:
+            nodes.extend(str(node) for node in NodeSet(str(target)))
+        else:
+            nodes.append(str(target))
+    return nodes
+
+
+class Target(object):
+    """A node to scrape, with its own keep-alive http connection."""
+
+    def __init__(self, node, port, timeout):
+        self.node = node
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+        self.families = []
+        self.up = False
+        self.duration = None
+
+    def fetch(self):
+        # Connection is kept open between rounds, and only opened again
+        # after an error.
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.node, self.port, timeout=self.timeout)
+        self.connection.request('GET', '/metrics', headers={'Accept-Encoding': 'gzip'})
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise http.client.HTTPException('HTTP status ' + str(response.status))
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body.decode('utf-8')
+
+    def scrape(self):
+        # A slow node must not be scraped twice at the same time
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            start = time.monotonic()
+            try:
+                self.families = list(text_string_to_metric_families(self.fetch()))
+                if not self.up:
+                    logger.info('Target is up', extra={'node': self.node})
+                self.up = True
+            except Exception as e:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                if self.up:
+                    logger.warning('Target is down', extra={'node': self.node, 'error': repr(e)})
+                self.up = False
+                self.families = []
+            self.duration = time.monotonic() - start
+        finally:
+            self.lock.release()
+
+
+class Collector(object):
+
+    def __init__(self, parameters):
+        # Parameters:
+        #   targets: list of nodes (or nodesets) to scrape
+        #   port: bb_exporter port on targets, default 9777
+        #   timeout: seconds before a target is considered down, default 5
+        #   workers: number of targets scraped in parallel, default 32
+        #   label: label added to metrics with the target name, default hostname
+        #   exclude: target metrics names prefixes not forwarded, default none.
+        #     Metrics also exposed by the aggregator own exporter are merged
+        #     with them by bb_exporter.
+        parameters = parameters or {}
+        port = int(parameters.get('port', 9777))
+        timeout = float(parameters.get('timeout', 5))
+        self.label = str(parameters.get('label', 'hostname'))
+        self.exclude = tuple(parameters.get('exclude') or [])
+        self.targets = [Target(node, port, timeout) for node in expand_targets(parameters.get('targets') or [])]
+        self.pool = ThreadPoolExecutor(max_workers=int(parameters.get('workers', 32)))
+        logger.info('Aggregating targets', extra={'targets': len(self.targets)})
+
+    def close(self):
+        # Called by bb_exporter when collector is unregistered (configuration reload)
+        self.pool.shutdown(wait=False)
+        for target in self.targets:
+            if target.connection is not None:
+                target.connection.close()
+
+    def collect(self):
+        # Scrape all targets in parallel, then merge their metrics families,
+        # adding the target name as a label.
+        list(self.pool.map(lambda target: target.scrape(), self.targets))
+
+        families = {}
+        gauge_up = GaugeMetricFamily('bb_exporter_aggregator_target_up', 'Aggregated target could be scraped (1) or not (0)', labels=[self.label])
+        gauge_duration = GaugeMetricFamily('bb_exporter_aggregator_target_scrape_duration_seconds', 'Aggregated target scrape duration', labels=[self.label])
+        for target in self.targets:
+            gauge_up.add_metric([target.node], float(target.up))
+            if target.duration is not None:
+                gauge_duration.add_metric([target.node], target.duration)
+            for family in target.families:
+                if family.name.startswith(self.exclude):
+                    continue
+                if family.name not in families:
+                    families[family.name] = Metric(family.name, family.documentation, family.type)
+                elif families[family.name].type != family.type:
+                    # Targets running different versions
+                    continue
+                for sample in family.samples:
+                    labels = dict(sample.labels)
+                    # A label of the target with the same name is kept, as
+                    # Prometheus does, under exported_<label>
+                    if self.label in labels:
+                        labels['exported_' + self.label] = labels[self.label]
+                    labels[self.label] = target.node
+                    families[family.name].add_sample(sample.name, labels, sample.value, sample.timestamp)
+
+        for family in families.values():
+            yield family
+        yield gauge_up
+        yield gauge_duration
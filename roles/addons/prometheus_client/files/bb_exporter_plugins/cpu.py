@@ -2,9 +2,12 @@
 # 2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
+import logging
 import psutil
 from prometheus_client.core import GaugeMetricFamily
 
+logger = logging.getLogger('bb_exporter.cpu')
+
 
 class Collector(object):
 
@@ -14,6 +17,6 @@ class Collector(object):
     def collect(self):
         g = GaugeMetricFamily('system_cpu_load_percent', 'System CPU load in percent, from psutil')
         cpu_load = psutil.cpu_percent()
-        print('CPU collector. cpu load: '+str(cpu_load))
+        logger.debug('CPU load', extra={'value': cpu_load})
         g.add_metric(['cpu_load'], cpu_load)
         yield g
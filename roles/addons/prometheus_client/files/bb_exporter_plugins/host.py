@@ -0,0 +1,154 @@
+# Host CPU and memory plugin for bb exporter
+# Reads /proc/stat, /proc/meminfo and NUMA nodes meminfo directly, without psutil.
+# https://github.com/bluebanquise/bluebanquise - MIT license
+
+import glob
+import os
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Columns of cpu lines in /proc/stat, see man 5 proc
+CPU_MODES = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal']
+IDLE_MODES = (3, 4)  # idle and iowait
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+# /proc/meminfo fields exported, and their metric names
+MEMINFO_FIELDS = {
+    b'MemTotal': 'system_memory_total_bytes',
+    b'MemFree': 'system_memory_free_bytes',
+    b'MemAvailable': 'system_memory_available_bytes',
+    b'Buffers': 'system_memory_buffers_bytes',
+    b'Cached': 'system_memory_cached_bytes',
+    b'SwapTotal': 'system_memory_swap_total_bytes',
+    b'SwapFree': 'system_memory_swap_free_bytes',
+}
+HUGEPAGES_FIELDS = {
+    b'HugePages_Total': 'total',
+    b'HugePages_Free': 'free',
+    b'HugePages_Rsvd': 'reserved',
+    b'HugePages_Surp': 'surplus',
+}
+NUMA_FIELDS = {
+    b'MemTotal': 'total',
+    b'MemFree': 'free',
+    b'MemUsed': 'used',
+}
+MEMINFO_KEYS = set(MEMINFO_FIELDS) | set(HUGEPAGES_FIELDS) | {b'Hugepagesize'}
+NUMA_KEYS = set(NUMA_FIELDS) | set(HUGEPAGES_FIELDS)
+
+
+class ProcFile(object):
+    """Keep a procfs file open, and read it again into the same buffer."""
+
+    def __init__(self, path, size=16384):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(size)
+
+    def read(self):
+        while True:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            length = os.readv(self.fd, [self.buffer])
+            if length < len(self.buffer):
+                return memoryview(self.buffer)[:length].tobytes()
+            # File did not fit, grow buffer and read again
+            self.buffer = bytearray(len(self.buffer) * 2)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def parse_meminfo(content, fields):
+    # Lines are "Key:   value kB", or "Node 0 Key:   value kB" for NUMA nodes
+    values = {}
+    for line in content.splitlines():
+        key, _, value = line.partition(b':')
+        key = key.rsplit(b' ', 1)[-1]
+        if key in fields:
+            value = value.split()
+            values[key] = int(value[0]) * (1024 if len(value) > 1 else 1)
+    return values
+
+
+class Collector(object):
+
+    def __init__(self, parameters):
+        # Parameters are optional:
+        #   per_core: export per core metrics, default true
+        #   numa: export per NUMA node metrics, default true
+        parameters = parameters or {}
+        self.per_core = bool(parameters.get('per_core', True))
+        self.stat = ProcFile('/proc/stat')
+        self.meminfo = ProcFile('/proc/meminfo')
+        self.numa_nodes = {}
+        if bool(parameters.get('numa', True)):
+            for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/meminfo')):
+                self.numa_nodes[os.path.basename(os.path.dirname(path))[4:]] = ProcFile(path)
+        self.previous = {}
+
+    def close(self):
+        # Called by bb_exporter when collector is unregistered (configuration reload)
+        for procfile in [self.stat, self.meminfo] + list(self.numa_nodes.values()):
+            procfile.close()
+
+    def collect(self):
+        counter_cpu = CounterMetricFamily('system_cpu_seconds', 'Time spent by CPUs in each mode, from /proc/stat', labels=['cpu', 'mode'])
+        gauge_cpu_usage = GaugeMetricFamily('system_cpu_usage_ratio', 'CPU busy ratio since previous collection, from /proc/stat', labels=['cpu'])
+
+        current = {}
+        for line in self.stat.read().splitlines():
+            if not line.startswith(b'cpu'):
+                # cpu lines are always first in /proc/stat
+                break
+            fields = line.split()
+            cpu = fields[0][3:].decode() or 'all'
+            if cpu != 'all' and not self.per_core:
+                continue
+            ticks = [int(value) for value in fields[1:len(CPU_MODES)+1]]
+            current[cpu] = ticks
+            for mode, value in zip(CPU_MODES, ticks):
+                counter_cpu.add_metric([cpu, mode], value / CLOCK_TICKS)
+            # Usage is computed from counters deltas, so it does not depend on
+            # when the previous collection was made, and ignores scrape jitter.
+            previous = self.previous.get(cpu)
+            if previous is not None:
+                total = sum(ticks) - sum(previous)
+                idle = sum(ticks[i] - previous[i] for i in IDLE_MODES)
+                if total > 0:
+                    gauge_cpu_usage.add_metric([cpu], (total - idle) / float(total))
+        self.previous = current
+        yield counter_cpu
+        yield gauge_cpu_usage
+
+        meminfo = parse_meminfo(self.meminfo.read(), MEMINFO_KEYS)
+        for field, name in MEMINFO_FIELDS.items():
+            if field in meminfo:
+                g = GaugeMetricFamily(name, 'System memory '+field.decode()+', from /proc/meminfo')
+                g.add_metric([], float(meminfo[field]))
+                yield g
+        if b'MemTotal' in meminfo and b'MemAvailable' in meminfo:
+            g = GaugeMetricFamily('system_memory_used_ratio', 'System memory used ratio, from MemTotal and MemAvailable')
+            g.add_metric([], 1.0 - meminfo[b'MemAvailable'] / float(meminfo[b'MemTotal']))
+            yield g
+        g = GaugeMetricFamily('system_hugepages', 'System huge pages, per state, from /proc/meminfo', labels=['state'])
+        for field, state in HUGEPAGES_FIELDS.items():
+            if field in meminfo:
+                g.add_metric([state], float(meminfo[field]))
+        yield g
+        if b'Hugepagesize' in meminfo:
+            g = GaugeMetricFamily('system_hugepages_size_bytes', 'System huge pages size, from /proc/meminfo')
+            g.add_metric([], float(meminfo[b'Hugepagesize']))
+            yield g
+
+        if self.numa_nodes:
+            gauge_numa_memory = GaugeMetricFamily('system_numa_memory_bytes', 'NUMA node memory, per state', labels=['node', 'state'])
+            gauge_numa_hugepages = GaugeMetricFamily('system_numa_hugepages', 'NUMA node huge pages, per state', labels=['node', 'state'])
+            for node, procfile in self.numa_nodes.items():
+                node_meminfo = parse_meminfo(procfile.read(), NUMA_KEYS)
+                for field, state in NUMA_FIELDS.items():
+                    if field in node_meminfo:
+                        gauge_numa_memory.add_metric([node, state], float(node_meminfo[field]))
+                for field, state in HUGEPAGES_FIELDS.items():
+                    if field in node_meminfo:
+                        gauge_numa_hugepages.add_metric([node, state], float(node_meminfo[field]))
+            yield gauge_numa_memory
+            yield gauge_numa_hugepages
@@ -2,29 +2,132 @@
 # 2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
-import os.path
+import logging
+import os
+import re
+import threading
+import time
 from prometheus_client.core import GaugeMetricFamily
 
+# Mount points states
+NOT_MOUNTED = 0.0
+MOUNTED = 1.0
+HUNG = 2.0
+STATES_NAMES = {NOT_MOUNTED: 'not mounted', MOUNTED: 'mounted', HUNG: 'hung'}
 
-class Collector(object):
+logger = logging.getLogger('bb_exporter.mounted')
+
+
+def read_mount_points(mountinfo='/proc/self/mountinfo'):
+    # Reading mountinfo never touches the mounted file systems, so it does not
+    # block even if a remote server (NFS, Lustre, etc.) is gone.
+    mount_points = set()
+    with open(mountinfo, 'r') as f:
+        for line in f:
+            # Fifth field is the mount point, with spaces and special chars
+            # escaped in octal (\040 for space).
+            mount_point = line.split(' ', 5)[4]
+            if '\\' in mount_point:
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), mount_point)
+            mount_points.add(mount_point)
+    return mount_points
+
+
+class MountProbe(object):
+    """stat() a mount point in a dedicated thread, to detect hung file systems.
+
+    A hung stat() cannot be interrupted, so a new probe is only started once
+    the previous one has returned: at most one thread is stuck per mount point.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.started = 0.0
+        self.latency = None
+
+    def run(self):
+        try:
+            os.stat(self.path)
+        except OSError:
+            pass
+        self.latency = time.monotonic() - self.started
+
+    def start(self):
+        if self.is_hung():
+            return False
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='bb_exporter_mount_probe')
+        self.thread.daemon = True
+        self.thread.start()
+        return True
 
-    mounted_points = {}
+    def is_hung(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def elapsed(self):
+        if self.is_hung():
+            return time.monotonic() - self.started
+        return self.latency
+
+
+class Collector(object):
 
     def __init__(self, parameters):
-        self.mounted_points = parameters
-        print('Mounted points exporter. To watch:')
-        for point_to_check in self.mounted_points:
-            print('  - '+point_to_check)
+        # Parameters can be a simple list of mount points, or a dict:
+        #   paths: list of mount points to watch
+        #   probe: also stat() mounted points to detect hung ones, default false
+        #   probe_timeout: seconds before a mount point is considered hung, default 5
+        if isinstance(parameters, dict):
+            paths = parameters.get('paths') or []
+            probe = bool(parameters.get('probe', False))
+            self.probe_timeout = float(parameters.get('probe_timeout', 5))
+        else:
+            paths = parameters or []
+            probe = False
+            self.probe_timeout = 5.0
+        self.mounted_points = [os.path.normpath(path) for path in paths]
+        self.probes = {}
+        if probe:
+            self.probes = {path: MountProbe(path) for path in self.mounted_points}
+        self.states = {}
+        logger.info('Watching mount points', extra={'paths': ','.join(self.mounted_points)})
+
+    def set_state(self, path, state):
+        # Only log state changes, not the state of each point at each collection
+        previous = self.states.get(path)
+        if previous != state:
+            level = logging.INFO if state == MOUNTED else logging.WARNING
+            logger.log(level, 'Mount point state changed', extra={'path': path, 'state': STATES_NAMES[state]})
+            self.states[path] = state
 
     def collect(self):
-        gauge_mounted_points = GaugeMetricFamily('system_mounted_points_state', 'System mounted points', labels=['path'])
+        gauge_mounted_points = GaugeMetricFamily('system_mounted_points_state', 'System mounted points, 0 not mounted, 1 mounted, 2 hung', labels=['path'])
+        gauge_probe_latency = GaugeMetricFamily('system_mounted_points_probe_latency_seconds', 'System mounted points stat() latency, or time spent in a hung stat()', labels=['path'])
+
+        mount_points = read_mount_points()
+
+        # Start all probes at once, then wait for them until a common deadline.
+        # Probes still hung since a previous collection are not waited for.
+        started = []
+        for path in self.mounted_points:
+            if path in mount_points and path in self.probes and self.probes[path].start():
+                started.append(self.probes[path])
+        deadline = time.monotonic() + self.probe_timeout
+        for probe in started:
+            probe.thread.join(max(deadline - time.monotonic(), 0))
 
         for point_to_check in self.mounted_points:
-            result = os.path.ismount(point_to_check)
-            if result:  # result is True
-                print('Mounted collector. Point '+point_to_check+' state: Mounted')
-                gauge_mounted_points.add_metric([point_to_check], 1.0)
+            probe = self.probes.get(point_to_check)
+            if point_to_check not in mount_points:
+                state = NOT_MOUNTED
+            elif probe is not None and probe.is_hung():
+                state = HUNG
             else:
-                print('Mounted collector. Point '+point_to_check+' state: Not Mounted')
-                gauge_mounted_points.add_metric([point_to_check], 0.0)
+                state = MOUNTED
+            self.set_state(point_to_check, state)
+            gauge_mounted_points.add_metric([point_to_check], state)
+            if state != NOT_MOUNTED and probe is not None and probe.elapsed() is not None:
+                gauge_probe_latency.add_metric([point_to_check], probe.elapsed())
         yield gauge_mounted_points
+        yield gauge_probe_latency
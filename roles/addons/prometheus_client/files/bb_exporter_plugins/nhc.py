@@ -1,26 +1,143 @@
-# CPU usage plugin for bb exporter
+# NHC plugin for bb exporter
 # 2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
+import logging
+import random
 import subprocess
-import sys
+import threading
+import time
 from prometheus_client.core import GaugeMetricFamily
 
+logger = logging.getLogger('bb_exporter.nhc')
 
-class Collector(object):
-    def __init__(self, empty):
-        pass
 
-    def collect(self):
+class NHCRunner(object):
+    """Run nhc and keep its last verdict: exit code, timestamp and duration."""
+
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.retcode = None
+        self.timestamp = None
+        self.duration = None
+        self.stop_event = threading.Event()
+        # Running nhc, so that it can be terminated when runner is stopped
+        self.process = None
+        self.lock = threading.Lock()
+
+    def run(self):
+        start = time.monotonic()
         try:
-            retcode = subprocess.call("nhc", shell=True)
+            with self.lock:
+                if self.stop_event.is_set():
+                    return
+                self.process = subprocess.Popen(self.command)
+            try:
+                retcode = self.process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+                raise
+            if self.stop_event.is_set():
+                # Terminated by stop, this is not a verdict
+                return
             if retcode < 0:
-                print("Child was terminated by signal", -retcode, file=sys.stderr)
-            else:
-                print("Child returned", retcode, file=sys.stderr)
+                logger.error('nhc was terminated by signal', extra={'signal': -retcode})
+        except subprocess.TimeoutExpired:
+            logger.error('nhc did not end in time', extra={'timeout': self.timeout})
+            retcode = -1
         except OSError as e:
-            print("Execution failed:", e, file=sys.stderr)
+            logger.error('nhc execution failed', extra={'error': str(e)})
+            retcode = -1
+        self.duration = time.monotonic() - start
+        self.timestamp = time.time()
+        if retcode != self.retcode:
+            level = logging.INFO if retcode == 0 else logging.WARNING
+            logger.log(level, 'nhc verdict changed', extra={'retcode': retcode, 'previous_retcode': self.retcode})
+        else:
+            logger.debug('nhc verdict', extra={'retcode': retcode, 'duration': self.duration})
+        self.retcode = retcode
+
+    def loop(self, interval, jitter):
+        # Random initial delay, so that nodes of the cluster do not all run
+        # nhc at the same time.
+        if self.stop_event.wait(random.uniform(0, jitter)):
+            return
+        while True:
+            start = time.monotonic()
+            self.run()
+            if self.stop_event.wait(max(interval - (time.monotonic() - start), 0)):
+                return
+
+    def stop(self, kill=False):
+        # No new run is started, and running nhc is terminated (or killed)
+        with self.lock:
+            self.stop_event.set()
+            process = self.process
+        if process is not None and process.poll() is None:
+            if kill:
+                process.kill()
+            else:
+                process.terminate()
+
+
+class Collector(object):
+
+    def __init__(self, parameters):
+        # Parameters are optional:
+        #   background: run nhc on its own schedule (true), or at each collection (false, default)
+        #   interval: seconds between two nhc runs in background, default 300
+        #   jitter: maximum random delay before first background run, default interval
+        #   timeout: seconds before nhc is considered hung, default 120
+        #   command: nhc command line, default nhc
+        parameters = parameters or {}
+        self.background = bool(parameters.get('background', False))
+        command = parameters.get('command', 'nhc')
+        if isinstance(command, str):
+            command = command.split()
+        self.runner = NHCRunner(command, float(parameters.get('timeout', 120)))
+        self.thread = None
+        if self.background:
+            interval = float(parameters.get('interval', 300))
+            jitter = float(parameters.get('jitter', interval))
+            self.thread = threading.Thread(target=self.runner.loop, args=(interval, jitter), name='bb_exporter_nhc')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def resume(self, previous):
+        # Called by bb_exporter on configuration reload, before previous
+        # instance is closed. Its last verdict is reported until the new
+        # runner completes its first run, after its initial random delay.
+        if self.runner.retcode is None and previous.runner.retcode is not None:
+            self.runner.duration = previous.runner.duration
+            self.runner.timestamp = previous.runner.timestamp
+            self.runner.retcode = previous.runner.retcode
+
+    def close(self):
+        # Called by bb_exporter when collector is unregistered (configuration
+        # reload). Running nhc is terminated and background runner waited
+        # for, so that it does not overlap with runs of the new instance.
+        self.runner.stop()
+        if self.thread is not None:
+            self.thread.join(5)
+            if self.thread.is_alive():
+                logger.warning('nhc did not end on SIGTERM, killing it')
+                self.runner.stop(kill=True)
+                self.thread.join()
+
+    def collect(self):
+        if not self.background:
+            self.runner.run()
+        if self.runner.retcode is None:
+            # Background runner did not complete its first run yet
+            return
         g = GaugeMetricFamily("system_nhc_status", 'Node Health Checker exit code')
-        print('NHC collector. retcode = '+str(retcode))
-        g.add_metric(["nhc_exit_code"], retcode)
+        g.add_metric(["nhc_exit_code"], self.runner.retcode)
+        yield g
+        g = GaugeMetricFamily("system_nhc_last_run_timestamp_seconds", 'Node Health Checker last run end time, as unix timestamp')
+        g.add_metric([], self.runner.timestamp)
+        yield g
+        g = GaugeMetricFamily("system_nhc_last_run_duration_seconds", 'Node Health Checker last run duration')
+        g.add_metric([], self.runner.duration)
         yield g
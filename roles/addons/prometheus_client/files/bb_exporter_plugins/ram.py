@@ -2,9 +2,12 @@
 # 2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
+import logging
 import psutil
 from prometheus_client.core import GaugeMetricFamily
 
+logger = logging.getLogger('bb_exporter.ram')
+
 
 class Collector(object):
 
@@ -14,6 +17,6 @@ class Collector(object):
     def collect(self):
         g = GaugeMetricFamily('system_ram_load_bytes', 'System RAM load in bytes, from psutil')
         ram_load = psutil.virtual_memory()[2]
-        print('RAM collector. RAM load: '+str(ram_load))
+        logger.debug('RAM load', extra={'value': ram_load})
         g.add_metric(['ram_load'], ram_load)
         yield g
@@ -2,33 +2,76 @@
 # 2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
-from pystemd.systemd1 import Unit
+import errno
+import logging
+from pystemd.dbusexc import DBusError
+from pystemd.systemd1 import Manager
 from prometheus_client.core import GaugeMetricFamily
 
+# Possible values of systemd units ActiveState property
+ACTIVE_STATES = ['active', 'reloading', 'inactive', 'failed', 'activating', 'deactivating']
 
-class Collector(object):
+logger = logging.getLogger('bb_exporter.services')
+
+
+def unit_name(service):
+    # Allow short services names in configuration, like sshd for sshd.service
+    if '.' not in service:
+        return service + '.service'
+    return service
 
-    services = {}
-    services_status = []
+
+class Collector(object):
 
     def __init__(self, parameters):
-        self.services = parameters
-        print('Services collector. Loading services status:')
-        for idx, service in enumerate(self.services):
-            print('  - Loading '+service)
-            self.services_status.append(Unit(service, _autoload=True))
-            print(self.services_status)
+        self.services = list(parameters or [])
+        self.units = [unit_name(service).encode() for service in self.services]
+        self.states = {}
+        logger.info('Watching services', extra={'services': ','.join(self.services)})
+        # A single connection to systemd manager is kept for all units
+        self.manager = Manager(_autoload=True)
+        self.list_units_by_names = True
+
+    def units_states(self):
+        # All watched units states are retrieved in a single D-Bus call.
+        # ListUnitsByNames is not available before systemd 230 (RHEL 7), fall
+        # back to ListUnits, that lists all loaded units, in a single call too.
+        units = None
+        if self.list_units_by_names:
+            try:
+                units = self.manager.Manager.ListUnitsByNames(self.units)
+            except DBusError as e:
+                # sd-bus maps org.freedesktop.DBus.Error.UnknownMethod to EBADR
+                if getattr(e, 'errno', None) != errno.EBADR and 'UnknownMethod' not in str(e):
+                    raise
+                logger.info('ListUnitsByNames not supported by systemd, using ListUnits')
+                self.list_units_by_names = False
+        if units is None:
+            units = self.manager.Manager.ListUnits()
+        states = {}
+        for unit in units:
+            # (name, description, load_state, active_state, sub_state, ...)
+            states[unit[0]] = (unit[3].decode(), unit[4].decode())
+        return states
 
     def collect(self):
         gauge_services = GaugeMetricFamily('system_services_state', 'System services status', labels=['service'])
+        gauge_active_state = GaugeMetricFamily('system_services_active_state', 'System services systemd ActiveState, 1 for current state', labels=['service', 'state'])
+        gauge_sub_state = GaugeMetricFamily('system_services_sub_state', 'System services systemd SubState, 1 for current state', labels=['service', 'sub_state'])
 
-        for idx, service in enumerate(self.services):
-            result = self.services_status[idx].Unit.SubState
-            if 'running' in str(result):
-                print('Services collector. Service '+service+' is running.')
-                gauge_services.add_metric([service], 1.0)
-            else:
-                print('Services collector. Service '+service+' is stopped.')
-                gauge_services.add_metric([service], 0.0)
+        states = self.units_states()
+        for service, unit in zip(self.services, self.units):
+            active_state, sub_state = states.get(unit, ('inactive', 'dead'))
+            # Only log state changes, not the state of each service at each collection
+            if self.states.get(service) != (active_state, sub_state):
+                level = logging.INFO if sub_state == 'running' else logging.WARNING
+                logger.log(level, 'Service state changed', extra={'service': service, 'active_state': active_state, 'sub_state': sub_state})
+                self.states[service] = (active_state, sub_state)
+            gauge_services.add_metric([service], float(sub_state == 'running'))
+            for state in ACTIVE_STATES:
+                gauge_active_state.add_metric([service, state], float(state == active_state))
+            gauge_sub_state.add_metric([service, sub_state], 1.0)
 
         yield gauge_services
+        yield gauge_active_state
+        yield gauge_sub_state
@@ -5,85 +5,112 @@
 
 # Should be replaced by https://github.com/vpenso/prometheus-slurm-exporter
 
+import logging
 import subprocess
+import time
 from prometheus_client.core import GaugeMetricFamily
 
+logger = logging.getLogger('bb_exporter.slurm')
+
+# Node state flags, as appended by sinfo to the state name.
+# See "NODE STATE CODES" in sinfo manual.
+SLURM_STATE_FLAGS = {
+    '*': 'not_responding',
+    '~': 'powered_off',
+    '#': 'powering_up',
+    '!': 'powering_down_pending',
+    '%': 'powering_down',
+    '$': 'maintenance',
+    '@': 'reboot_pending',
+    '^': 'reboot_issued',
+    '-': 'planned',
+    '+': 'multiple_states',
+}
+
+
+def parse_sinfo(output):
+    """Parse 'sinfo --noheader --Node --format=%N|%R|%T' output.
+
+    Returns nodes states (each node counted once), nodes flags, and per
+    partition nodes states.
+    """
+    nodes = {}
+    partitions = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) != 3:
+            continue
+        node, partition, state = fields
+        flags = set()
+        while state and state[-1] in SLURM_STATE_FLAGS:
+            flags.add(SLURM_STATE_FLAGS[state[-1]])
+            state = state[:-1]
+        # A node can be in multiple partitions, and so be reported multiple times
+        nodes[node] = (state, flags)
+        partition_states = partitions.setdefault(partition, {})
+        partition_states[state] = partition_states.get(state, 0) + 1
+
+    states = {}
+    flags = {}
+    for state, node_flags in nodes.values():
+        states[state] = states.get(state, 0) + 1
+        for flag in node_flags:
+            flags[flag] = flags.get(flag, 0) + 1
+    return states, flags, partitions
+
 
 class Collector(object):
-    def __init__(self, empty):
-        pass
+
+    def __init__(self, parameters):
+        # Parameters are optional:
+        #   cache_ttl: seconds during which a sinfo result is reused
+        #   timeout: seconds before sinfo is considered hung
+        parameters = parameters or {}
+        self.cache_ttl = float(parameters.get('cache_ttl', 30))
+        self.timeout = float(parameters.get('timeout', 10))
+        self.cache = None
+        self.cache_time = 0.0
+
+    def sinfo(self):
+        now = time.monotonic()
+        if self.cache is not None and now - self.cache_time < self.cache_ttl:
+            return self.cache
+        try:
+            result = subprocess.run(['sinfo', '--noheader', '--Node', '--format=%N|%R|%T'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True, timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error('sinfo execution failed', extra={'error': str(e)})
+            return None
+        if result.returncode != 0:
+            logger.error('sinfo failed', extra={'retcode': result.returncode, 'error': result.stderr.strip()})
+            return None
+        self.cache = parse_sinfo(result.stdout)
+        self.cache_time = now
+        return self.cache
 
     def collect(self):
         gauge_nodes_states_total = GaugeMetricFamily('slurm_nodes_state_total', 'Slurm nodes states, total per state. From sinfo.', labels=['state'])
+        gauge_nodes_flags_total = GaugeMetricFamily('slurm_nodes_flag_total', 'Slurm nodes state flags, total per flag. From sinfo.', labels=['flag'])
+        gauge_nodes_total = GaugeMetricFamily('slurm_nodes_total', 'Slurm nodes, total. From sinfo.')
+        gauge_partitions_states_total = GaugeMetricFamily('slurm_partition_nodes_state_total', 'Slurm nodes states, total per partition and state. From sinfo.', labels=['partition', 'state'])
 
-        # Gather down nodes, and exclude unknown status nodes (down*)
-        try:
-            stdout, stderr = subprocess.Popen("sinfo --format='%T %D' | grep down | grep -v '*' |awk -F ' ' '{print $2}'", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
-            try:
-                nb_nodes_down = float(stdout)
-            except ValueError:
-                nb_nodes_down = 0.0
-            print("Slurm Exporter. nb_nodes_down: "+str(nb_nodes_down))
-            gauge_nodes_states_total.add_metric(["down"], nb_nodes_down)
-        except OSError as e:
-            print("Execution failed:", e, file=stderr)
-
-#        try:
-#            nb_nodes_down = subprocess.call("sinfo --format='%T %D' | grep down | grep -v '*' |awk -F ' ' '{print $2}'", shell=True)
-#            if nb_nodes_down < 0:
-#                print("Child was terminated by signal", -nb_nodes_down, file=sys.stderr)
-#            else:
-#                print("Child returned", nb_nodes_down, file=sys.stderr)
-#                gauge_nodes_states_total.add_metric(["down"], nb_nodes_down)
-#        except OSError as e:
-#            print("Execution failed:", e, file=sys.stderr)
-
-        # Gather drain nodes, and exclude unknown status nodes (drain*)
-        try:
-            stdout, stderr = subprocess.Popen("sinfo --format='%T %D' | grep drain | grep -v '*' |awk -F ' ' '{print $2}'", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
-            try:
-                nb_nodes_drain = float(stdout)
-            except ValueError:
-                nb_nodes_drain = 0.0
-            print("Slurm Exporter. nb_nodes_drain: "+str(nb_nodes_drain))
-            gauge_nodes_states_total.add_metric(["drain"], nb_nodes_drain)
-        except OSError as e:
-            print("Execution failed:", e, file=stderr)
-
-        # Gather idle nodes, and exclude unknown status nodes (idle*)
-        try:
-            stdout, stderr = subprocess.Popen("sinfo --format='%T %D' | grep idle | grep -v '*' |awk -F ' ' '{print $2}'", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
-            try:
-                nb_nodes_idle = float(stdout)
-            except ValueError:
-                nb_nodes_idle = 0.0
-            print("Slurm Exporter. nb_nodes_idle: "+str(nb_nodes_idle))
-            gauge_nodes_states_total.add_metric(["idle"], nb_nodes_idle)
-        except OSError as e:
-            print("Execution failed:", e, file=stderr)
-
-        # Gather alloc nodes, and exclude unknown status nodes (alloc*)
-        try:
-            stdout, stderr = subprocess.Popen("sinfo --format='%T %D' | grep alloc | grep -v '*' |awk -F ' ' '{print $2}'", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
-            try:
-                nb_nodes_alloc = float(stdout)
-            except ValueError:
-                nb_nodes_alloc = 0.0
-            print("Slurm Exporter. nb_nodes_alloc: "+str(nb_nodes_alloc))
-            gauge_nodes_states_total.add_metric(["alloc"], nb_nodes_alloc)
-        except OSError as e:
-            print("Execution failed:", e, file=stderr)
-
-        # Deduce remaining nodes, and assume they are unknown state
-        try:
-            stdout, stderr = subprocess.Popen("sinfo --format=%D | grep -v NODES", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True).communicate()
-            try:
-                nb_nodes = float(stdout)
-            except ValueError:
-                nb_nodes = 0.0
-            print("Slurm Exporter. nb_nodes_unk: "+str(nb_nodes-(nb_nodes_alloc+nb_nodes_idle+nb_nodes_drain+nb_nodes_down)))
-            gauge_nodes_states_total.add_metric(["unk"], nb_nodes-(nb_nodes_alloc+nb_nodes_idle+nb_nodes_drain+nb_nodes_down))
-        except OSError as e:
-            print("Execution failed:", e, file=stderr)
+        sinfo = self.sinfo()
+        if sinfo is None:
+            return
+        states, flags, partitions = sinfo
+
+        for state, count in states.items():
+            gauge_nodes_states_total.add_metric([state], float(count))
+        for flag, count in flags.items():
+            gauge_nodes_flags_total.add_metric([flag], float(count))
+        gauge_nodes_total.add_metric([], float(sum(states.values())))
+        for partition, partition_states in partitions.items():
+            for state, count in partition_states.items():
+                gauge_partitions_states_total.add_metric([partition, state], float(count))
+        logger.debug('Nodes states', extra={'states': ','.join(state + '=' + str(count) for state, count in sorted(states.items()))})
 
         yield gauge_nodes_states_total
+        yield gauge_nodes_flags_total
+        yield gauge_nodes_total
+        yield gauge_partitions_states_total
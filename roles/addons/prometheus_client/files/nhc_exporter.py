@@ -1,32 +1,71 @@
 # This is a minimal exporter, to be used as a reference.
+# nhc is run in background on its own schedule, and scrapes only report the
+# last verdict, so that scrapes cost nothing on compute nodes.
 
-import time
+import random
 import subprocess
 import sys
+import threading
+import time
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
 from prometheus_client import start_http_server
 
+NHC_INTERVAL = 300  # Seconds between two nhc runs
+NHC_JITTER = 300    # Maximum random delay before first run, to spread nodes
+NHC_TIMEOUT = 120   # Seconds before nhc is considered hung
+
 
 class CustomCollector(object):
     def __init__(self):
-        pass
+        self.retcode = None
+        self.timestamp = None
+        self.duration = None
 
-    def collect(self):
+    def run_nhc(self):
+        start = time.monotonic()
         try:
-            retcode = subprocess.call("nhc", shell=True)
+            retcode = subprocess.call(['nhc'], timeout=NHC_TIMEOUT)
             if retcode < 0:
                 print("Child was terminated by signal", -retcode, file=sys.stderr)
             else:
                 print("Child returned", retcode, file=sys.stderr)
+        except subprocess.TimeoutExpired:
+            print("nhc did not end after", NHC_TIMEOUT, "seconds", file=sys.stderr)
+            retcode = -1
         except OSError as e:
             print("Execution failed:", e, file=sys.stderr)
+            retcode = -1
+        self.duration = time.monotonic() - start
+        self.timestamp = time.time()
+        self.retcode = retcode
+
+    def loop(self):
+        time.sleep(random.uniform(0, NHC_JITTER))
+        while True:
+            start = time.monotonic()
+            self.run_nhc()
+            time.sleep(max(NHC_INTERVAL - (time.monotonic() - start), 0))
+
+    def collect(self):
+        if self.retcode is None:
+            return
         g = GaugeMetricFamily("nhc", 'Node Health Checker')
-        g.add_metric(["nhc_exit_code"], retcode)
+        g.add_metric(["nhc_exit_code"], self.retcode)
+        yield g
+        g = GaugeMetricFamily("nhc_last_run_timestamp_seconds", 'Node Health Checker last run end time, as unix timestamp')
+        g.add_metric([], self.timestamp)
+        yield g
+        g = GaugeMetricFamily("nhc_last_run_duration_seconds", 'Node Health Checker last run duration')
+        g.add_metric([], self.duration)
         yield g
 
 
 if __name__ == '__main__':
     start_http_server(8777)
-    REGISTRY.register(CustomCollector())
+    collector = CustomCollector()
+    thread = threading.Thread(target=collector.loop)
+    thread.daemon = True
+    thread.start()
+    REGISTRY.register(collector)
     while True:
         time.sleep(1)
@@ -11,17 +11,46 @@
 # 2019_2020 - Benoît Leveugle <benoit.leveugle@sphenisc.com>
 #             Adrien Ribeiro <adrien.ribeiro@atos.net>
 # https://github.com/bluebanquise/bluebanquise - MIT license
+#
+# Can be used as a command line tool, or imported as a library:
+#
+#   import bootset
+#   bootset.set_boot('c[001-100]', 'diskless', image='myimage')
+#   bootset.status('c[001-100]')
+#
+# or run as a daemon, serving json requests on a Unix socket (see call_daemon),
+# and optionally nodes iPXE scripts over http, rendered from memory.
 
 import grp
+import hashlib
+import json
 import logging
 import os
+import pickle
 import pwd
 import re
+import signal
+import socket
+import socketserver
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import yaml
 from ClusterShell.NodeSet import NodeSet
 
+try:
+    import selinux
+except ImportError:
+    selinux = None
+
 
 # Colors, from https://stackoverflow.com/questions/287871/how-to-print-colored-text-in-terminal-in-python
 class bcolors:
@@ -35,173 +64,614 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-def load_file(filename):
-    logging.info(bcolors.OKBLUE+'Loading '+filename+bcolors.ENDC)
-    with open(filename, 'r') as f:
-        # return yaml.load(f, Loader=yaml.FullLoader) ## Waiting for PyYaml 5.1
-        return yaml.load(f)
-
-
-def set_default_boot(node, boot, node_image=None, extra_parameters=None):
-    logging.info('    ├── '+bcolors.OKBLUE+'Switching boot to '+boot+bcolors.ENDC)
-    logging.info('    ├── '+bcolors.OKBLUE+'Editing file /var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe'+bcolors.ENDC)
-    with open('/var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe', 'r') as f:
-        filebuffer = f.readlines()
-    for i in range(len(filebuffer)):
-        if 'menu-default' in filebuffer[i]:
-            filebuffer[i] = 'set menu-default boot{}\n'.format(boot)
-        if ('node-image' in filebuffer[i]) and (node_image is not None):
-            filebuffer[i] = 'set node-image {}\n'.format(node_image)
-        if ('extra-parameters' in filebuffer[i]) and (extra_parameters is not None):
-            filebuffer[i] = 'set extra-parameters {}\n'.format(extra_parameters)
-    with open('/var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe', 'w') as f:
-        f.writelines(filebuffer)
-    logging.info('    └── '+bcolors.OKGREEN+'[OK] Done.'+bcolors.ENDC)
-
-
-# Get arguments passed to bootset
-parser = ArgumentParser()
-parser.add_argument("-n", "--nodes", dest="nodes",
-                    help="Target node(s). Use nodeset format for ranges.", metavar="NODE")
-parser.add_argument("-s", "--status", dest="status", nargs='?', const='',
-                    help="Display current nodes boot target status.")
-parser.add_argument("-b", "--boot", dest="boot",
-                    help="Next pxe boot: can be osdeploy, diskless, clone, clonedeploy, or disk.")
-parser.add_argument("-f", "--force", dest="force", default=" ",
-                    help="Force. 'dhcp' = better dracut dhcp, 'network' = static ip. Combine using comma separator.")
-parser.add_argument("-i", "--image", dest="image", default="none",
-                    help="Specify diskless or clone image to be used, if using diskless/clone/clonedeploy boot.")
-parser.add_argument("-e", "--extra-parameters", dest="extra_parameters", default="none",
-                    help="Add extra parameters for boot chain, some addons may need some.")
-parser.add_argument("-k", "--kickstart", action="store_true",
-                    help="Display the kickstart file of a node")
-parser.add_argument("-q", "--quiet", action="store_true",
-                    help="Do not print INFO messages.")
-
-passed_arguments = parser.parse_args()
-
-# Enable logging
-loglevel = logging.INFO
-if passed_arguments.quiet:
-    loglevel = logging.WARNING
-logging.basicConfig(format='[%(levelname)s] %(message)s', level=loglevel)
-
-# Load and extract configuration files
-nodes_parameters = load_file('/etc/bluebanquise/pxe/nodes_parameters.yml')
-pxe_parameters = load_file('/etc/bluebanquise/pxe/pxe_parameters.yml')
-
-apache_uid = pwd.getpwnam(pxe_parameters["pxe_parameters"]["apache_uid"]).pw_uid
-apache_gid = grp.getgrnam(pxe_parameters["pxe_parameters"]["apache_gid"]).gr_gid
-
+nodes_parameters_file = '/etc/bluebanquise/pxe/nodes_parameters.yml'
+pxe_parameters_file = '/etc/bluebanquise/pxe/pxe_parameters.yml'
 pxe_nodes_path = '/var/www/html/preboot_execution_environment/nodes/'
+pxe_equipment_profiles_path = '/var/www/html/preboot_execution_environment/equipment_profiles/'
+pxe_index_file = '/var/www/html/preboot_execution_environment/bootset_index.json'
+INDEX_VERSION = 2
+cache_path = '/var/cache/bluebanquise/bootset'
+CACHE_VERSION = 1
+daemon_socket = '/run/bootset.sock'
+daemon_http_port = 8180
+
+# Known boot types. Addons can use boot types derived from these ones.
+BOOT_TYPES = ['osdeploy', 'diskless', 'clone', 'clonedeploy', 'disk']
+
+
+class BootsetError(Exception):
+    pass
+
+
+# C (libyaml) loader is much faster than the pure python one, when available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Files already loaded by this process: {filename: (mtime, size, data)}
+loaded_files = {}
 
-if passed_arguments.status is not None:
-    diskfull = NodeSet()
-    diskless = dict()
-    osdeploy = NodeSet()
-
-    # Iteration on nodes
-    for node in NodeSet(passed_arguments.nodes):
-        # Check if node file exist
-        ipxe_file = os.path.join(pxe_nodes_path, '{node}.ipxe'.format(node=node))
-        if not os.path.exists(ipxe_file):
-            logging.warning(bcolors.WARNING + 'File ' + ipxe_file + ' does not exist. Skipping.' + bcolors.ENDC)
+
+def load_file(filename):
+    # Parsed content is kept in memory, for long running processes, and cached
+    # as pickle, in a root only folder, and reused as long as the yaml file did
+    # not change. mtime and size are checked first, then the sha256 of the
+    # content, so a file rewritten with the same content is not parsed again.
+    cache_file = os.path.join(cache_path, os.path.basename(filename)+'.pickle')
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if filename in loaded_files and loaded_files[filename][:2] == (stat.st_mtime_ns, stat.st_size):
+            return loaded_files[filename][2]
+        cache = None
+        try:
+            with open(cache_file, 'rb') as fc:
+                cache = pickle.load(fc)
+        except Exception:
+            pass
+        if cache is not None and cache.get('version') == CACHE_VERSION and (cache['mtime'], cache['size']) == (stat.st_mtime_ns, stat.st_size):
+            logging.debug(bcolors.OKBLUE+'Loading '+filename+' from cache'+bcolors.ENDC)
+            loaded_files[filename] = (stat.st_mtime_ns, stat.st_size, cache['data'])
+            return cache['data']
+        content = f.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    if cache is not None and cache.get('version') == CACHE_VERSION and cache['sha256'] == sha256:
+        logging.debug(bcolors.OKBLUE+'Loading '+filename+' from cache'+bcolors.ENDC)
+        data = cache['data']
+    else:
+        logging.info(bcolors.OKBLUE+'Loading '+filename+bcolors.ENDC)
+        data = yaml.load(content, Loader=YAML_LOADER)
+
+    try:
+        os.makedirs(cache_path, mode=0o700, exist_ok=True)
+        tmp_cache_file = cache_file+'.'+str(threading.get_ident())+'.tmp'
+        with open(tmp_cache_file, 'wb') as fc:
+            pickle.dump({'version': CACHE_VERSION, 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256, 'data': data},
+                        fc, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_cache_file, cache_file)
+    except OSError as e:
+        logging.debug(bcolors.WARNING+'Could not write cache '+cache_file+': '+str(e)+bcolors.ENDC)
+    loaded_files[filename] = (stat.st_mtime_ns, stat.st_size, data)
+    return data
+
+
+# Node iPXE file. Per node values are substituted in a single pass, iPXE
+# variables are escaped as ${{...}}.
+NODE_IPXE_TEMPLATE = '''#!ipxe
+echo | Entering {node}.ipxe file.
+echo |
+echo | Getting host specific variables...
+# Current default action
+set menu-default boot{boot}
+# Current node parameters:
+set equipment-profile {equipment_profile}
+set dedicated-kernel-parameters {dedicated_parameters}
+set node-image {node_image}
+set extra-parameters {extra_parameters}
+echo |
+# Now chain to menu menu
+echo | Now chaining to --> equipment_profiles/${{equipment-profile}}.ipxe
+sleep 2
+chain http://${{next-server}}/preboot_execution_environment/equipment_profiles/${{equipment-profile}}.ipxe || shell
+'''
+
+
+class Template(object):
+    """str.format like template, parsed once, then rendered by a single join."""
+
+    def __init__(self, template):
+        self.parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+    def render(self, values):
+        return ''.join([literal + values[field] if field is not None else literal for literal, field in self.parts])
+
+
+node_ipxe_template = Template(NODE_IPXE_TEMPLATE)
+
+
+def render_node_ipxe(node, equipment_profile, dedicated_parameters, boot, node_image, extra_parameters):
+    # Final content of the node file is generated at once, no file is edited afterwards
+    return node_ipxe_template.render({'node': node, 'boot': boot, 'equipment_profile': str(equipment_profile),
+                                      'dedicated_parameters': dedicated_parameters, 'node_image': node_image,
+                                      'extra_parameters': extra_parameters})
+
+
+def dedicated_kernel_parameters(node, node_parameters, force):
+    dedicated_parameters = str('')
+    if 'network' in force:
+        dedicated_parameters = str('ip='+node_parameters["network"]["node_main_network_interface_ip"]+'::'+node_parameters["network"]["node_main_network_gateway"]+':'+node_parameters["network"]["node_main_network_netmask"]+':'+node+':'+node_parameters["network"]["node_main_network_interface"]+':none')
+    if 'dhcp' in force:
+        dedicated_parameters = dedicated_parameters + ' rd.net.timeout.carrier=30 rd.net.timeout.ifup=60 rd.net.dhcp.retry=4 '
+    return dedicated_parameters
+
+
+@lru_cache()
+def owner_ids(user, group):
+    return pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid
+
+
+def write_node_file(path, content, uid, gid):
+    # Write into a temporary file of the same folder, then rename it: the http
+    # server never serves a partially written file. Temporary file is unique,
+    # as the daemon and command line bootset may write the same node at once.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            os.fchmod(f.fileno(), 0o644)
+            os.fchown(f.fileno(), uid, gid)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logging.debug(bcolors.OKGREEN+'[OK] '+path+bcolors.ENDC)
+    return os.stat(path).st_mtime_ns
+
+
+def restore_selinux_contexts(paths):
+    # Without python selinux bindings, a single restorecon call for all files
+    if selinux is not None:
+        for path in paths:
+            selinux.restorecon(path)
+    else:
+        subprocess.run(['restorecon', '-f', '-'], input='\n'.join(paths)+'\n', universal_newlines=True)
+
+
+class BootIndex(object):
+    """Index of nodes boot status:
+    {node: {'boot':, 'image':, 'kernel_parameters':, 'extra_parameters':, 'mtime':}}
+
+    Kept in memory, and saved as json next to nodes folder. A missing or
+    unreadable index is simply rebuilt from nodes files. When deferred, saves
+    are only done by flush(), so that a daemon does not write the whole index
+    at each boot change.
+    """
+
+    def __init__(self, path, deferred=False):
+        self.path = path
+        self.deferred = deferred
+        self.nodes = {}
+        self.mtime = None
+        self.dirty = False
+
+    def load(self):
+        # Index is read again only if modified by another process
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.nodes
+        if mtime == self.mtime or self.dirty:
+            return self.nodes
+        try:
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                self.nodes = index['nodes']
+        except (OSError, ValueError, KeyError):
+            pass
+        self.mtime = mtime
+        return self.nodes
+
+    def changed(self):
+        self.dirty = True
+        if not self.deferred:
+            self.flush()
+
+    def flush(self):
+        if not self.dirty:
+            return
+        tmp_index_file = None
+        try:
+            # Unique temporary file, as several bootset may save the index
+            fd, tmp_index_file = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.bootset_index.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                os.fchmod(f.fileno(), 0o644)
+                # Copy, as http threads of the daemon may add nodes meanwhile
+                json.dump({'version': INDEX_VERSION, 'nodes': dict(self.nodes)}, f)
+            os.replace(tmp_index_file, self.path)
+            self.mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logging.warning(bcolors.WARNING+'Could not save index '+self.path+': '+str(e)+bcolors.ENDC)
+            if tmp_index_file is not None and os.path.exists(tmp_index_file):
+                os.remove(tmp_index_file)
+        self.dirty = False
+
+
+index = BootIndex(pxe_index_file)
+
+
+def parse_node_ipxe(ipxe_conf):
+    # Returns node values as stored in index, enough to render the file again
+    values = dict(re.findall(r"^set (menu-default|dedicated-kernel-parameters|node-image|extra-parameters) ?(.*)$", ipxe_conf, re.MULTILINE))
+    return {'boot': values['menu-default'][len('boot'):], 'image': values.get('node-image') or 'none',
+            'kernel_parameters': values.get('dedicated-kernel-parameters', ''),
+            'extra_parameters': values.get('extra-parameters') or 'none'}
+
+
+def node_status(node, nodes_index):
+    # Node file is only read if it changed since it was indexed.
+    # Returns (boot, image), or None if node has no file.
+    ipxe_file = os.path.join(pxe_nodes_path, node+'.ipxe')
+    try:
+        mtime = os.stat(ipxe_file).st_mtime_ns
+    except FileNotFoundError:
+        nodes_index.pop(node, None)
+        return None
+    entry = nodes_index.get(node)
+    if entry is None or entry['mtime'] != mtime:
+        with open(ipxe_file, 'r') as f:
+            entry = parse_node_ipxe(f.read())
+        entry['mtime'] = mtime
+        nodes_index[node] = entry
+    return entry['boot'], entry['image']
+
+
+def status(nodes):
+    """Return current boot status of nodes, as {boot: {image: NodeSet}}.
+
+    Nodes without iPXE file are logged and skipped.
+    """
+    boot_status = dict()
+    nodes_index = index.load()
+    index_size = len(nodes_index)
+    index_changed = False
+
+    for node in NodeSet(nodes):
+        node = str(node)
+        entry = nodes_index.get(node)
+        node_boot_status = node_status(node, nodes_index)
+        index_changed = index_changed or nodes_index.get(node) is not entry
+        if node_boot_status is None:
+            logging.warning(bcolors.WARNING + 'File ' + os.path.join(pxe_nodes_path, node+'.ipxe') + ' does not exist. Skipping.' + bcolors.ENDC)
             continue
-        else:
-            with open(ipxe_file, 'r') as f:
-                ipxe_conf = f.read()
-                # Search the default boot type in the ipxe file
-                boot = re.search(r"^set menu-default boot(.+)", ipxe_conf, re.MULTILINE).group(1)
-
-                if boot == 'disk':
-                    diskfull.update(node)
-                elif boot == 'osdeploy':
-                    osdeploy.update(node)
-                elif boot == 'diskless':
-                    # If diskless, group nodes per image
-                    image = re.search(r"^set node-image (.+)", ipxe_conf, re.MULTILINE).group(1)
-                    if image not in diskless:
-                        diskless[image] = NodeSet()
-                    diskless[image].update(node)
-
-    # Display NodeSet per boot type
-    if len(diskfull):
-        print('Diskfull: {nodes}'.format(nodes=diskfull))
-    if len(osdeploy):
-        print('Next boot deployment: {nodes}'.format(nodes=osdeploy))
-    if len(diskless):
-        print('Diskless image(s):')
-        for image in diskless:
-            print(' - {image}: {nodes}'.format(image=image, nodes=diskless[image]))
-
-elif passed_arguments.boot is not None:
+        boot, image = node_boot_status
+        boot_status.setdefault(boot, dict()).setdefault(image, NodeSet()).update(node)
+
+    if index_changed or len(nodes_index) != index_size:
+        index.changed()
+    return boot_status
 
+
+def set_boot(nodes, boot, image='none', extra_parameters='none', force='', workers=None):
+    """Set next PXE boot of nodes.
+
+    Returns a dict of NodeSet: 'done' nodes, 'unknown' nodes (not in
+    nodes_parameters.yml) and 'failed' nodes (file could not be written).
+    Raises BootsetError if boot is not a known boot type.
+    """
     # Ensure passed boot argument exists
-    if passed_arguments.boot is not None and 'osdeploy' not in passed_arguments.boot and 'diskless' not in passed_arguments.boot and 'clone' not in passed_arguments.boot and 'clonedeploy' not in passed_arguments.boot and 'disk' not in passed_arguments.boot:
-        logging.error(bcolors.FAIL+'Passed argument "'+passed_arguments.boot+'" for boot not know. Please check syntax.'+bcolors.ENDC)
-        quit()
-
-    # Iteration on nodes
-    for node in NodeSet(passed_arguments.nodes):
-
-        # Check if node exist in Ansible generated file
-        logging.info(bcolors.OKBLUE+'Cheking if node '+str(node)+' exist...'+bcolors.ENDC)
-        if str(node) in nodes_parameters:
-
-            logging.info(bcolors.OKGREEN+'[OK] Working on node '+str(node)+' ...'+bcolors.ENDC)
-            # Check if we need to create or update files
-            logging.info('    ├── '+bcolors.OKBLUE+'Checking '+str(node)+' files...'+bcolors.ENDC)
-            if str(os.path.exists('/var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe')) == 'False':
-                logging.info('    ├── '+bcolors.OKBLUE+'Creating file /var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe'+bcolors.ENDC)
+    if boot is None or not any(boot_type in boot for boot_type in BOOT_TYPES):
+        raise BootsetError('Passed argument "'+str(boot)+'" for boot not know. Please check syntax.')
+
+    nodes_parameters = load_file(nodes_parameters_file)
+    pxe_parameters = load_file(pxe_parameters_file)
+    apache_uid, apache_gid = owner_ids(pxe_parameters["pxe_parameters"]["apache_uid"], pxe_parameters["pxe_parameters"]["apache_gid"])
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+
+    # Render all nodes files content first, in a single pass
+    node_files = {}
+    kernel_parameters = {}
+    result = {'done': NodeSet(), 'unknown': NodeSet(), 'failed': NodeSet()}
+    for node in NodeSet(nodes):
+        node = str(node)
+        if node not in nodes_parameters:
+            result['unknown'].update(node)
+            continue
+        kernel_parameters[node] = dedicated_kernel_parameters(node, nodes_parameters[node], force)
+        node_files[node] = render_node_ipxe(node, nodes_parameters[node]['equipment_profile'], kernel_parameters[node],
+                                            boot, image, extra_parameters)
+
+    if len(result['unknown']):
+        logging.warning(bcolors.WARNING+'Node(s) '+str(result['unknown'])+' do not exist. Skipping.'+bcolors.ENDC)
+
+    # Then write them in parallel, if worth it
+    nodes_index = index.load()
+    written_files = []
+    if workers > 1 and len(node_files) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {node: executor.submit(write_node_file, os.path.join(pxe_nodes_path, node+'.ipxe'), content, apache_uid, apache_gid)
+                       for node, content in node_files.items()}
+    else:
+        futures = {node: None for node in node_files}
+    for node, future in futures.items():
+        path = os.path.join(pxe_nodes_path, node+'.ipxe')
+        try:
+            if future is None:
+                mtime = write_node_file(path, node_files[node], apache_uid, apache_gid)
             else:
-                logging.info('    ├── '+bcolors.OKBLUE+'Editing file /var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe'+bcolors.ENDC)
-            dedicated_parameters = str('')
-            if 'network' in passed_arguments.force:
-                dedicated_parameters = str('ip='+nodes_parameters[str(node)]["network"]["node_main_network_interface_ip"]+'::'+nodes_parameters[str(node)]["network"]["node_main_network_gateway"]+':'+nodes_parameters[str(node)]["network"]["node_main_network_netmask"]+':'+str(node)+':'+nodes_parameters[str(node)]["network"]["node_main_network_interface"]+':none')
-            if 'dhcp' in passed_arguments.force:
-                dedicated_parameters = dedicated_parameters + ' rd.net.timeout.carrier=30 rd.net.timeout.ifup=60 rd.net.dhcp.retry=4 '
-
-            generic_node_ipxe = '\n'.join((
-                '#!ipxe',
-                'echo | Entering {}.ipxe file.'.format(node),
-                'echo |',
-                'echo | Getting host specific variables...',
-                '# Current default action',
-                'set menu-default bootdisk',
-                '# Current node parameters:',
-                'set equipment-profile {}'.format(nodes_parameters[str(node)]['equipment_profile']),
-                'set dedicated-kernel-parameters {}'.format(dedicated_parameters),
-                'set node-image none',
-                'set extra-parameters none',
-                'echo |',
-                '# Now chain to menu menu',
-                'echo | Now chaining to --> equipment_profiles/${equipment-profile}.ipxe',
-                'sleep 2',
-                'chain http://${next-server}/preboot_execution_environment/equipment_profiles/${equipment-profile}.ipxe || shell'))
-
-            with open('/var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe', 'w') as ff:
-                ff.write(generic_node_ipxe)
-            os.chown('/var/www/html/preboot_execution_environment/nodes/'+str(node)+'.ipxe', apache_uid, apache_gid)
-            logging.info('    ├── '+bcolors.OKGREEN+'[OK] Done.'+bcolors.ENDC)
-
-            set_default_boot(node=node, boot=passed_arguments.boot, node_image=passed_arguments.image, extra_parameters=passed_arguments.extra_parameters)
-
-        else:
-            logging.warning(bcolors.WARNING+'Node '+str(node)+' do not exist. Skipping.'+bcolors.ENDC)
-
-    # Ensure SELinux context is correct
-    if pxe_parameters["pxe_parameters"]["ansible_selinux_status"] == "enabled":
-        os.system('restorecon -Rv /var/www/html/preboot_execution_environment/nodes/')
-
-elif passed_arguments.kickstart is not None:
-
-    node = passed_arguments.nodes
-    if len(NodeSet(node)) != 1:
-        logging.error(bcolors.FAIL + 'Specify a single node with -n to display its kickstart file.' + bcolors.ENDC)
+                mtime = future.result()
+        except OSError as e:
+            logging.error(bcolors.FAIL+'Could not write '+path+': '+str(e)+bcolors.ENDC)
+            result['failed'].update(node)
+            continue
+        written_files.append(path)
+        result['done'].update(node)
+        nodes_index[node] = {'boot': boot, 'image': image, 'kernel_parameters': kernel_parameters[node],
+                             'extra_parameters': extra_parameters, 'mtime': mtime}
+    if written_files:
+        index.changed()
+
+    # Ensure SELinux context is correct, only for written files
+    if written_files and pxe_parameters["pxe_parameters"]["ansible_selinux_status"] == "enabled":
+        restore_selinux_contexts(written_files)
+    return result
+
+
+def kickstart(node):
+    """Return the kickstart file content of a node."""
+    if node is None or len(NodeSet(node)) != 1:
+        raise BootsetError('Specify a single node to display its kickstart file.')
+    nodes_parameters = load_file(nodes_parameters_file)
+    # The kickstart.cfg file is created by Ansible role pxe_stack
+    with open(os.path.join(pxe_equipment_profiles_path, '{profile}.kickstart.cfg'.format(profile=nodes_parameters[str(node)]['equipment_profile'])), "r") as f:
+        return f.read()
+
+
+def node_ipxe(node, nodes_parameters=None, nodes_index=None):
+    """Return iPXE script of a node, rendered from its parameters and index entry.
+
+    Returns None if node is unknown, or has no boot set.
+    """
+    if nodes_parameters is None:
+        nodes_parameters = load_file(nodes_parameters_file)
+    if nodes_index is None:
+        nodes_index = index.load()
+    if node not in nodes_parameters:
+        return None
+    # Node file can be modified outside of bootset, like by bootswitch.cgi at
+    # the end of a deployment, so it is checked against its index entry, as
+    # status does. Only a stat is needed if it did not change.
+    entry = nodes_index.get(node)
+    if node_status(node, nodes_index) is None:
+        if entry is not None:
+            index.changed()
+        return None
+    if nodes_index[node] is not entry:
+        entry = nodes_index[node]
+        index.changed()
+    return render_node_ipxe(node, nodes_parameters[node]['equipment_profile'], entry['kernel_parameters'],
+                            entry['boot'], entry['image'], entry['extra_parameters'])
+
+
+def handle_request(request):
+    # Daemon requests and responses are json objects, NodeSet are sent as strings
+    action = request.get('action')
+    if action == 'set_boot':
+        result = set_boot(request['nodes'], request['boot'], request.get('image', 'none'), request.get('extra_parameters', 'none'),
+                          request.get('force', ''), request.get('workers'))
+        return {key: str(nodes) for key, nodes in result.items()}
+    elif action == 'status':
+        return {boot: {image: str(nodes) for image, nodes in images.items()} for boot, images in status(request['nodes']).items()}
+    elif action == 'kickstart':
+        return kickstart(request['node'])
+    raise BootsetError('Unknown action '+str(action))
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """One json request per line, answered by one json response per line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'result': handle_request(json.loads(line.decode()))}
+            except Exception as e:
+                logging.error(bcolors.FAIL+'Request failed: '+repr(e)+bcolors.ENDC)
+                response = {'error': str(e)}
+            self.wfile.write((json.dumps(response)+'\n').encode())
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Requests are served one at a time, and the index is saved at most every second."""
+
+    last_flush = 0.0
+
+    def service_actions(self):
+        if index.dirty and time.monotonic() - self.last_flush > 1:
+            index.flush()
+            self.last_flush = time.monotonic()
+
+
+class NodesHttpHandler(BaseHTTPRequestHandler):
+    """Serve nodes iPXE scripts, at the same path than static nodes files."""
+
+    protocol_version = 'HTTP/1.1'
+    node_path = re.compile(r'^(?:/preboot_execution_environment)?/nodes/([\w.-]+)\.ipxe$')
+
+    def node_script(self, node):
+        nodes_parameters, nodes_index = self.server.tables()
+        return node_ipxe(node, nodes_parameters, nodes_index)
+
+    def do_GET(self):
+        match = self.node_path.match(self.path.split('?', 1)[0])
+        content = None
+        if match is not None:
+            try:
+                content = self.node_script(match.group(1))
+            except Exception as e:
+                logging.error(bcolors.FAIL+'Could not render '+self.path+': '+repr(e)+bcolors.ENDC)
+                self.send_error(500)
+                return
+        if content is None:
+            self.send_error(404)
+            return
+        content = content.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # A rack booting would flood logs
+        logging.debug(self.address_string()+' '+format % args)
+
+
+class NodesHttpServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Parameters file and index are checked for changes at most every second.
+
+    Boot changes made by the daemon itself are served immediately, as the
+    index is shared.
+    """
+
+    daemon_threads = True
+    refresh_interval = 1.0
+
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.refresh_lock = threading.Lock()
+        self.last_refresh = 0.0
+        self.nodes_parameters = None
+        self.nodes_index = None
+
+    def tables(self):
+        with self.refresh_lock:
+            if time.monotonic() - self.last_refresh > self.refresh_interval:
+                self.nodes_parameters = load_file(nodes_parameters_file)
+                self.nodes_index = index.load()
+                self.last_refresh = time.monotonic()
+            return self.nodes_parameters, self.nodes_index
+
+
+def http_address(value):
+    # [address:]port, address defaults to localhost, behind Apache
+    address, _, port = value.rpartition(':')
+    return address or '127.0.0.1', int(port)
+
+
+def serve(socket_path=daemon_socket, http_address=None):
+    # Parameters files and index are kept in memory between requests
+    index.deferred = True
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Socket is created private, instead of being restricted after bind
+    previous_umask = os.umask(0o177)
+    try:
+        server = DaemonServer(socket_path, DaemonHandler)
+    finally:
+        os.umask(previous_umask)
+    os.chmod(socket_path, 0o600)
+    http_server = None
+    if http_address is not None:
+        http_server = NodesHttpServer(http_address, NodesHttpHandler)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        logging.info(bcolors.OKGREEN+'Serving nodes iPXE scripts on http://'+'{0}:{1}'.format(*http_address)+'/nodes/'+bcolors.ENDC)
+    # Stop cleanly on SIGTERM (systemctl stop), saving index and removing
+    # socket. Signals can only be handled by the main thread, a tool serving
+    # from another thread handles them itself.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info(bcolors.OKGREEN+'Listening on '+socket_path+bcolors.ENDC)
+    try:
+        server.serve_forever(poll_interval=0.5)
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+            http_server.server_close()
+        index.flush()
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def call_daemon(request, socket_path=daemon_socket):
+    """Send a request to a running bootset daemon, and return its result.
+
+    For example: call_daemon({'action': 'set_boot', 'nodes': 'c001', 'boot': 'disk'})
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(request)+'\n').encode())
+        response = json.loads(s.makefile('rb').readline().decode())
+    if 'error' in response:
+        raise BootsetError(response['error'])
+    return response['result']
+
+
+def main(arguments=None):
+    # Get arguments passed to bootset
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--nodes", dest="nodes",
+                        help="Target node(s). Use nodeset format for ranges.", metavar="NODE")
+    parser.add_argument("-s", "--status", dest="status", nargs='?', const='text', choices=['text', 'json', 'yaml'],
+                        help="Display current nodes boot target status. Optional output format: text (default), json or yaml.")
+    parser.add_argument("-b", "--boot", dest="boot",
+                        help="Next pxe boot: can be osdeploy, diskless, clone, clonedeploy, or disk.")
+    parser.add_argument("-f", "--force", dest="force", default=" ",
+                        help="Force. 'dhcp' = better dracut dhcp, 'network' = static ip. Combine using comma separator.")
+    parser.add_argument("-i", "--image", dest="image", default="none",
+                        help="Specify diskless or clone image to be used, if using diskless/clone/clonedeploy boot.")
+    parser.add_argument("-e", "--extra-parameters", dest="extra_parameters", default="none",
+                        help="Add extra parameters for boot chain, some addons may need some.")
+    parser.add_argument("-k", "--kickstart", action="store_true",
+                        help="Display the kickstart file of a node")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not print INFO messages.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print a message for each node file written.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                        help="Number of node files written in parallel.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Run as a daemon, serving requests on a Unix socket.")
+    parser.add_argument("--socket", dest="socket", default=daemon_socket,
+                        help="Unix socket path of daemon mode.")
+    parser.add_argument("--http", dest="http", type=http_address, nargs='?', const=('127.0.0.1', daemon_http_port), metavar="[ADDRESS:]PORT",
+                        help="In daemon mode, also serve nodes iPXE scripts over http (default 127.0.0.1:"+str(daemon_http_port)+").")
+
+    passed_arguments = parser.parse_args(arguments)
+
+    # Enable logging
+    loglevel = logging.INFO
+    if passed_arguments.quiet:
+        loglevel = logging.WARNING
+    elif passed_arguments.verbose:
+        loglevel = logging.DEBUG
+    logging.basicConfig(format='[%(levelname)s] %(message)s', level=loglevel)
+
+    try:
+        if passed_arguments.daemon:
+            serve(passed_arguments.socket, passed_arguments.http)
+
+        elif passed_arguments.status is not None:
+            boot_status = status(passed_arguments.nodes)
+
+            if passed_arguments.status == 'text':
+                # Display NodeSet per boot type
+                if 'disk' in boot_status:
+                    print('Diskfull: {nodes}'.format(nodes=NodeSet.fromlist(boot_status['disk'].values())))
+                if 'osdeploy' in boot_status:
+                    print('Next boot deployment: {nodes}'.format(nodes=NodeSet.fromlist(boot_status['osdeploy'].values())))
+                if 'diskless' in boot_status:
+                    print('Diskless image(s):')
+                    for image in sorted(boot_status['diskless']):
+                        print(' - {image}: {nodes}'.format(image=image, nodes=boot_status['diskless'][image]))
+                for boot in sorted(set(boot_status) - {'disk', 'osdeploy', 'diskless'}):
+                    print('Boot {boot} image(s):'.format(boot=boot))
+                    for image in sorted(boot_status[boot]):
+                        print(' - {image}: {nodes}'.format(image=image, nodes=boot_status[boot][image]))
+            else:
+                boot_status = {boot: {image: str(nodes) for image, nodes in images.items()} for boot, images in boot_status.items()}
+                if passed_arguments.status == 'json':
+                    print(json.dumps(boot_status, indent=2, sort_keys=True))
+                else:
+                    print(yaml.safe_dump(boot_status, default_flow_style=False), end='')
+
+        elif passed_arguments.boot is not None:
+            result = set_boot(passed_arguments.nodes, passed_arguments.boot, passed_arguments.image, passed_arguments.extra_parameters,
+                              passed_arguments.force, max(passed_arguments.workers, 1))
+            image_message = ''
+            if passed_arguments.image != 'none':
+                image_message = ' with image '+passed_arguments.image
+            logging.info(bcolors.OKGREEN+'[OK] '+str(len(result['done']))+' node(s) set to boot '+passed_arguments.boot+image_message+'.'+bcolors.ENDC)
+            if len(result['failed']):
+                logging.error(bcolors.FAIL+str(len(result['failed']))+' node file(s) could not be written: '+str(result['failed'])+bcolors.ENDC)
+                exit(1)
+
+        elif passed_arguments.kickstart:
+            for line in kickstart(passed_arguments.nodes).splitlines():
+                print(line.strip())
+
+    except BootsetError as e:
+        logging.error(bcolors.FAIL+str(e)+bcolors.ENDC)
         exit(1)
 
-    # The kickstart.cfg file is created by Ansible role pxe_stack
-    with open(os.path.join('/var/www/html/preboot_execution_environment/equipment_profiles/',
-                           '{profile}.kickstart.cfg'.format(profile=nodes_parameters[node]['equipment_profile'])), "r") as f:
-        for line in f.readlines():
-            print(line.strip())
+
+if __name__ == '__main__':
+    main()
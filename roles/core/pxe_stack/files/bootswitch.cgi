@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 # https://github.com/bluebanquise/bluebanquise - MIT license
 
-from shutil import copyfile
 import cgi
 import cgitb
 import os
-import sys
+import re
 
 cgitb.enable()
 
@@ -15,14 +14,21 @@ node_boot = arguments['boot'].value
 
 print('Content-Type: text/html\n\n')
 
+# Node name is used in a path, do not allow to get out of nodes folder
+if not re.match(r'^[\w.-]+$', node_name):
+    print('Invalid node name')
+    exit(1)
+
 if node_boot == 'disk':
-    file = open('/var/www/html/preboot_execution_environment/nodes/'+str(node_name)+'.ipxe','r')
-    filebuffer = file.readlines()
-    for i in range(len(filebuffer)):
-        if 'menu-default' in filebuffer[i]:
-            filebuffer[i] = 'set menu-default bootdisk\n'
-    file.close
-    file = open('/var/www/html/preboot_execution_environment/nodes/'+str(node_name)+'.ipxe','w')
-    file.writelines(filebuffer)
-    file.close
+    node_file = '/var/www/html/preboot_execution_environment/nodes/'+node_name+'.ipxe'
+    with open(node_file, 'r') as f:
+        content = f.read()
+    # Only the "set menu-default" line is replaced, not comments or other
+    # lines containing menu-default.
+    content = re.sub(r'^set menu-default boot.*$', 'set menu-default bootdisk', content, flags=re.MULTILINE)
+    # File is replaced atomically, it can be downloaded by iPXE at any time
+    tmp_node_file = os.path.join(os.path.dirname(node_file), '.'+os.path.basename(node_file)+'.tmp')
+    with open(tmp_node_file, 'w') as f:
+        f.write(content)
+    os.replace(tmp_node_file, node_file)
     print('Boot set to disk')
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+# Benchmark and load test harness for bb_exporter and its plugins.
+#
+# Each plugin is run against local stand-ins (fake sinfo and nhc binaries,
+# fake mountinfo, mocked systemd bus, fake aggregated targets), so results
+# only depend on the exporter code and can be compared between releases.
+# The http endpoint is then loaded with concurrent scrapers.
+#
+# Results are written as json, on stdout or into the --output file.
+#
+# https://github.com/bluebanquise/bluebanquise - MIT license
+
+import argparse
+import functools
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+DEFAULT_EXPORTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'roles', 'addons', 'prometheus_client', 'files')
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+# Mocked pystemd, only what services plugin uses. All units are running.
+FAKE_PYSTEMD = '''
+class ManagerInterface(object):
+
+    def ListUnitsByNames(self, names):
+        return [(name, b'', b'loaded', b'active', b'running', b'', b'/', 0, b'', b'/') for name in names]
+
+    def ListUnits(self):
+        return []
+
+
+class Manager(object):
+
+    def __init__(self, _autoload=False):
+        self.Manager = ManagerInterface()
+'''
+
+FAKE_PYSTEMD_DBUSEXC = '''
+class DBusError(Exception):
+
+    def __init__(self, errno, message=''):
+        super(DBusError, self).__init__(message)
+        self.errno = errno
+'''
+
+SLURM_STATES = ['idle', 'allocated', 'mixed', 'drained', 'down*', 'idle~', 'allocated#']
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(int(p / 100.0 * len(values)), len(values) - 1)]
+    return {'count': len(values), 'mean': sum(values) / len(values), 'min': values[0],
+            'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': values[-1]}
+
+
+def read_proc_io():
+    # Number of read and write like syscalls of this process (all threads).
+    # Not available in some containers.
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['syscr']), int(fields['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def process_cpu_seconds(pid):
+    with open('/proc/' + str(pid) + '/stat', 'r') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15, the 2 first ones were split away
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+class StandIns(object):
+    """Create fake binaries, files and python modules in a temporary folder."""
+
+    def __init__(self, nodes, services, mounts, targets):
+        self.root = tempfile.mkdtemp(prefix='bb_exporter_benchmark_')
+        self.bin = os.path.join(self.root, 'bin')
+        self.lib = os.path.join(self.root, 'lib')
+        os.makedirs(self.bin)
+        os.makedirs(os.path.join(self.lib, 'pystemd'))
+
+        sinfo_output = os.path.join(self.root, 'sinfo.txt')
+        with open(sinfo_output, 'w') as f:
+            for i in range(nodes):
+                f.write('c{0:05d}|all|{1}\n'.format(i, SLURM_STATES[i % len(SLURM_STATES)]))
+                if i % 4 == 0:
+                    f.write('c{0:05d}|gpu|{1}\n'.format(i, SLURM_STATES[i % len(SLURM_STATES)]))
+        self.write_script('sinfo', 'exec cat ' + sinfo_output)
+        self.write_script('nhc', 'exit 0')
+
+        with open(os.path.join(self.lib, 'pystemd', '__init__.py'), 'w') as f:
+            f.write('')
+        with open(os.path.join(self.lib, 'pystemd', 'systemd1.py'), 'w') as f:
+            f.write(FAKE_PYSTEMD)
+        with open(os.path.join(self.lib, 'pystemd', 'dbusexc.py'), 'w') as f:
+            f.write(FAKE_PYSTEMD_DBUSEXC)
+        self.services = ['service{0}'.format(i) for i in range(services)]
+
+        # Watched mount points are real folders, so that probes stat() them
+        self.mountinfo = os.path.join(self.root, 'mountinfo')
+        self.mount_points = []
+        with open(self.mountinfo, 'w') as f:
+            for i in range(mounts):
+                path = os.path.join(self.root, 'mnt', 'point{0}'.format(i))
+                if i % 10 == 0:
+                    os.makedirs(path)
+                    self.mount_points.append(path)
+                f.write('{0} 1 0:{0} / {1} rw,relatime shared:{0} - nfs server:/export{0} rw\n'.format(i + 100, path))
+
+        self.targets = targets
+        self.target_server = None
+
+    def write_script(self, name, command):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + command + '\n')
+        os.chmod(path, 0o755)
+
+    def activate(self):
+        # Inherited by forked exporter process and by plugins subprocesses
+        os.environ['PATH'] = self.bin + os.pathsep + os.environ.get('PATH', '')
+        sys.path.insert(0, self.lib)
+
+    def start_targets(self, body):
+        # One http server answers for all aggregated targets, reached through
+        # different loopback addresses (127.0.0.1, 127.0.0.2, etc.)
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.target_server = Server(('0.0.0.0', 0), Handler)
+        thread = threading.Thread(target=self.target_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return ['127.0.0.{0}'.format(i + 1) for i in range(self.targets)], self.target_server.server_address[1]
+
+    def cleanup(self):
+        if self.target_server is not None:
+            self.target_server.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def plugins_configuration(stand_ins, targets, targets_port):
+    # Caches are disabled, to measure the real cost of each collection
+    return {
+        'slurm': {'cache_ttl': 0},
+        'nhc': {'background': False},
+        'services': stand_ins.services,
+        'mounted': {'paths': stand_ins.mount_points, 'probe': True},
+        'host': {'per_core': True, 'numa': True},
+        'cpu': None,
+        'ram': None,
+        'aggregator': {'targets': targets, 'port': targets_port, 'timeout': 5},
+    }
+
+
+def benchmark_plugin(bb_exporter, plugins_path, name, parameters, stand_ins, iterations, warmup):
+    module = bb_exporter.load_plugin(plugins_path, name)
+    if module is None:
+        return {'error': 'plugin could not be loaded'}
+    if name == 'mounted':
+        module.read_mount_points = functools.partial(module.read_mount_points, stand_ins.mountinfo)
+    try:
+        collector = module.Collector(parameters)
+    except Exception as e:
+        return {'error': repr(e)}
+
+    for i in range(warmup):
+        list(collector.collect())
+
+    latencies = []
+    rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+    rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = read_proc_io()
+    for i in range(iterations):
+        start = time.perf_counter()
+        metrics = list(collector.collect())
+        latencies.append(time.perf_counter() - start)
+    samples = sum(len(metric.samples) for metric in metrics)
+    rusage_self_end = resource.getrusage(resource.RUSAGE_SELF)
+    rusage_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_end = read_proc_io()
+
+    # Allocations are measured in a separate pass, tracing slows down python
+    allocated = []
+    retained = []
+    tracemalloc.start()
+    for i in range(min(iterations, 50)):
+        tracemalloc.clear_traces()
+        metrics = list(collector.collect())
+        current, peak = tracemalloc.get_traced_memory()
+        allocated.append(peak)
+        retained.append(current)
+        del metrics
+    tracemalloc.stop()
+
+    if hasattr(collector, 'close'):
+        collector.close()
+
+    result = {
+        'samples': samples,
+        'latency_seconds': percentiles(latencies),
+        'cpu_seconds_per_collect': {
+            'user': (rusage_self_end.ru_utime - rusage_self.ru_utime) / iterations,
+            'system': (rusage_self_end.ru_stime - rusage_self.ru_stime) / iterations,
+            'children': (rusage_children_end.ru_utime + rusage_children_end.ru_stime - rusage_children.ru_utime - rusage_children.ru_stime) / iterations,
+        },
+        'context_switches_per_collect': {
+            'voluntary': (rusage_self_end.ru_nvcsw - rusage_self.ru_nvcsw) / float(iterations),
+            'involuntary': (rusage_self_end.ru_nivcsw - rusage_self.ru_nivcsw) / float(iterations),
+        },
+        'peak_allocated_bytes': percentiles(allocated),
+        'retained_bytes': percentiles(retained),
+    }
+    if io is not None and io_end is not None:
+        result['syscalls_per_collect'] = {'read': (io_end[0] - io[0]) / float(iterations), 'write': (io_end[1] - io[1]) / float(iterations)}
+    return result
+
+
+def serve_exporter(exporter_path, configuration):
+    # Exporter runs in its own process, so that scrapers do not share its GIL
+    sys.path.insert(0, exporter_path)
+    import bb_exporter
+    bb_exporter.setup_logging({'level': 'warning'})
+    bb_exporter.start_metrics_server(configuration['http'])
+    engine = bb_exporter.build_engine(configuration)
+    engine.start()
+    bb_exporter.REGISTRY.register(bb_exporter.EngineProxy(engine))
+    while True:
+        time.sleep(3600)
+
+
+def wait_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def scraper(port, duration, use_gzip, latencies, errors, sizes):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Accept-Encoding': 'gzip'} if use_gzip else {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.request('GET', '/metrics', headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise http.client.HTTPException(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append(1)
+            connection.close()
+            continue
+        latencies.append(time.perf_counter() - start)
+        sizes.append(len(body))
+    connection.close()
+
+
+def benchmark_http(pid, port, scrapers, duration, use_gzip):
+    latencies = []
+    errors = []
+    sizes = []
+    threads = [threading.Thread(target=scraper, args=(port, duration, use_gzip, latencies, errors, sizes)) for i in range(scrapers)]
+    cpu = process_cpu_seconds(pid)
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    cpu = process_cpu_seconds(pid) - cpu
+    return {
+        'scrapers': scrapers,
+        'gzip': use_gzip,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / elapsed,
+        'body_bytes': sizes[-1] if sizes else None,
+        'latency_seconds': percentiles(latencies),
+        'exporter_cpu_seconds_per_request': cpu / len(latencies) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bb_exporter plugins and http endpoint, and write results as json.')
+    parser.add_argument('--exporter-path', default=DEFAULT_EXPORTER_PATH, help='folder containing bb_exporter.py and bb_exporter_plugins')
+    parser.add_argument('--plugins', nargs='*', default=['slurm', 'nhc', 'services', 'mounted', 'host', 'cpu', 'ram', 'aggregator'], help='plugins to benchmark')
+    parser.add_argument('--iterations', type=int, default=200, help='collections per plugin')
+    parser.add_argument('--warmup', type=int, default=5, help='collections per plugin before measuring')
+    parser.add_argument('--nodes', type=int, default=4096, help='nodes in fake sinfo output')
+    parser.add_argument('--services', type=int, default=20, help='watched services')
+    parser.add_argument('--mounts', type=int, default=200, help='lines in fake mountinfo, 1 out of 10 is watched')
+    parser.add_argument('--targets', type=int, default=16, help='fake aggregated targets')
+    parser.add_argument('--scrapers', type=int, nargs='*', default=[1, 4, 16], help='concurrent scrapers runs of the http endpoint')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of each http run')
+    parser.add_argument('--cache-window', type=float, default=1, help='exporter http cache_window')
+    parser.add_argument('--port', type=int, default=19777, help='exporter http port')
+    parser.add_argument('--no-gzip', action='store_true', help='do not request gzip encoding from the exporter')
+    parser.add_argument('--output', help='json results file, default stdout')
+    args = parser.parse_args()
+
+    exporter_path = os.path.abspath(args.exporter_path)
+    plugins_path = os.path.join(exporter_path, 'bb_exporter_plugins')
+    sys.path.insert(0, exporter_path)
+    import bb_exporter
+    import prometheus_client
+    from prometheus_client.exposition import generate_latest
+    bb_exporter.setup_logging({'level': 'warning'})
+
+    stand_ins = StandIns(args.nodes, args.services, args.mounts, args.targets)
+    exporter = None
+    try:
+        stand_ins.activate()
+        targets, targets_port = stand_ins.start_targets(generate_latest(prometheus_client.REGISTRY) * 4)
+        configuration = plugins_configuration(stand_ins, targets, targets_port)
+
+        results = {
+            'metadata': {
+                'time': time.time(),
+                'hostname': platform.node(),
+                'python': platform.python_version(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'parameters': vars(args),
+            },
+            'plugins': {},
+            'http': [],
+        }
+        for name in args.plugins:
+            sys.stderr.write('Benchmarking plugin ' + name + '\n')
+            results['plugins'][name] = benchmark_plugin(bb_exporter, plugins_path, name, configuration.get(name), stand_ins,
+                                                        args.iterations, args.warmup)
+
+        exporter_configuration = {
+            'plugins_path': plugins_path,
+            'http': {'port': args.port, 'address': '127.0.0.1', 'cache_window': args.cache_window},
+            'sampling': {'default_interval': 15},
+            'collectors': {name: configuration.get(name) for name in args.plugins if 'error' not in results['plugins'][name]},
+        }
+        if 'mounted' in exporter_configuration['collectors']:
+            # Forked exporter cannot use the patched module, watch real mount points
+            exporter_configuration['collectors']['mounted'] = {'paths': ['/'], 'probe': True}
+        exporter = multiprocessing.Process(target=serve_exporter, args=(exporter_path, exporter_configuration))
+        exporter.daemon = True
+        exporter.start()
+        if not wait_port(args.port, 30):
+            raise RuntimeError('exporter http server did not start')
+        for scrapers in args.scrapers:
+            sys.stderr.write('Scraping with ' + str(scrapers) + ' concurrent scrapers\n')
+            results['http'].append(benchmark_http(exporter.pid, args.port, scrapers, args.duration, not args.no_gzip))
+    finally:
+        if exporter is not None:
+            exporter.terminate()
+        stand_ins.cleanup()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
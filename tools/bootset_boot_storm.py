@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Boot storm simulator, comparing static nodes iPXE files with the bootset
+# http responder.
+#
+# A fake inventory of --nodes nodes is generated, and all nodes are set to
+# osdeploy using bootset API, so that static nodes files are written. Then
+# all nodes request their nodes/<node>.ipxe file at the same time, each on a
+# new connection, like iPXE does, with --concurrency clients in flight:
+#
+# * static: files are read from disk at each request,
+# * dynamic: scripts are rendered from bootset in memory table.
+#
+# Both are served by the same python http server in a dedicated process, so
+# that only the way scripts are produced differs. To compare with the real
+# stack, point --static-url to Apache serving the nodes folder and
+# --dynamic-url to a running bootset daemon (or its Apache proxy).
+#
+# Results are written as json, on stdout or into the --output file.
+#
+# https://github.com/bluebanquise/bluebanquise - MIT license
+
+import argparse
+import grp
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import pwd
+import queue
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import yaml
+
+DEFAULT_BOOTSET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'roles', 'core', 'pxe_stack', 'files')
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(int(p / 100.0 * len(values)), len(values) - 1)]
+    return {'count': len(values), 'mean': sum(values) / len(values), 'min': values[0],
+            'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': values[-1]}
+
+
+def process_cpu_seconds(pid):
+    with open('/proc/' + str(pid) + '/stat', 'r') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime are fields 14 and 15, the 2 first ones were split away
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def setup_inventory(bootset, workdir, nodes_count):
+    # Same layout than pxe_stack role, inside workdir
+    nodes = ['c{0:05d}'.format(i) for i in range(1, nodes_count + 1)]
+    nodes_parameters = {}
+    for i, node in enumerate(nodes):
+        nodes_parameters[node] = {
+            'equipment_profile': 'equipment_typeC',
+            'network': {
+                'node_main_network_interface': 'enp0s3',
+                'node_main_network_interface_ip': '10.11.{0}.{1}'.format(i // 250, i % 250 + 1),
+                'node_main_network_gateway': '10.11.0.254',
+                'node_main_network_netmask': '255.255.0.0',
+            },
+        }
+    # Files are owned by current user, instead of apache
+    pxe_parameters = {'pxe_parameters': {'apache_uid': pwd.getpwuid(os.getuid()).pw_name, 'apache_gid': grp.getgrgid(os.getgid()).gr_name,
+                                         'ansible_selinux_status': 'disabled'}}
+
+    bootset.nodes_parameters_file = os.path.join(workdir, 'nodes_parameters.yml')
+    bootset.pxe_parameters_file = os.path.join(workdir, 'pxe_parameters.yml')
+    bootset.pxe_nodes_path = os.path.join(workdir, 'preboot_execution_environment', 'nodes')
+    bootset.pxe_index_file = os.path.join(workdir, 'preboot_execution_environment', 'bootset_index.json')
+    bootset.cache_path = os.path.join(workdir, 'cache')
+    bootset.index = bootset.BootIndex(bootset.pxe_index_file)
+    os.makedirs(bootset.pxe_nodes_path)
+    with open(bootset.nodes_parameters_file, 'w') as f:
+        yaml.safe_dump(nodes_parameters, f, default_flow_style=False)
+    with open(bootset.pxe_parameters_file, 'w') as f:
+        yaml.safe_dump(pxe_parameters, f, default_flow_style=False)
+    return nodes
+
+
+def serve(bootset, mode, port):
+    # Server runs in its own process, so that clients do not share its GIL
+
+    class StaticNodesHttpHandler(bootset.NodesHttpHandler):
+
+        def node_script(self, node):
+            try:
+                with open(os.path.join(bootset.pxe_nodes_path, node + '.ipxe'), 'r') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+    class StormHttpServer(bootset.NodesHttpServer):
+        # Whole storm can wait in listen backlog
+        request_queue_size = 1024
+
+    handler = StaticNodesHttpHandler if mode == 'static' else bootset.NodesHttpHandler
+    StormHttpServer(('127.0.0.1', port), handler).serve_forever()
+
+
+def wait_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def client(host, port, path, nodes, start, latencies, errors, bodies):
+    start.wait()
+    while True:
+        try:
+            node = nodes.get_nowait()
+        except queue.Empty:
+            return
+        begin = time.perf_counter()
+        # One connection per node, as each node is a distinct iPXE client
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        try:
+            connection.request('GET', path + node + '.ipxe')
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise http.client.HTTPException(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append(node)
+            continue
+        finally:
+            connection.close()
+        latencies.append(time.perf_counter() - begin)
+        bodies[node] = body
+
+
+def boot_storm(url, nodes, concurrency, pid=None):
+    url = urlsplit(url)
+    path = url.path if url.path.endswith('/') else url.path + '/'
+    pending = queue.Queue()
+    for node in nodes:
+        pending.put(node)
+    latencies = []
+    errors = []
+    bodies = {}
+    start = threading.Event()
+    threads = [threading.Thread(target=client, args=(url.hostname, url.port or 80, path, pending, start, latencies, errors, bodies))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    cpu = process_cpu_seconds(pid) if pid is not None else None
+    begin = time.monotonic()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - begin
+    result = {
+        'url': url.geturl(),
+        'nodes': len(nodes),
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'storm_seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'latency_seconds': percentiles(latencies),
+    }
+    if pid is not None:
+        result['server_cpu_seconds_per_request'] = (process_cpu_seconds(pid) - cpu) / max(len(latencies), 1)
+    return result, bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a boot storm against static and dynamic nodes iPXE scripts, and write results as json.')
+    parser.add_argument('--bootset-path', default=DEFAULT_BOOTSET_PATH, help='folder containing bootset.py')
+    parser.add_argument('--nodes', type=int, default=2000, help='nodes booting at the same time')
+    parser.add_argument('--concurrency', type=int, default=200, help='requests in flight')
+    parser.add_argument('--rounds', type=int, default=3, help='storms per mode')
+    parser.add_argument('--port', type=int, default=18180, help='first local http port, one per mode')
+    parser.add_argument('--static-url', help='url of an existing static nodes folder, instead of local server')
+    parser.add_argument('--dynamic-url', help='url of an existing bootset http responder, instead of local server')
+    parser.add_argument('--output', help='json results file, default stdout')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.bootset_path))
+    import bootset
+
+    workdir = tempfile.mkdtemp(prefix='bootset_boot_storm_')
+    servers = []
+    try:
+        nodes = setup_inventory(bootset, workdir, args.nodes)
+        begin = time.monotonic()
+        bootset.set_boot(bootset.NodeSet.fromlist(nodes), 'osdeploy', force='dhcp')
+        set_boot_seconds = time.monotonic() - begin
+
+        results = {
+            'metadata': {
+                'time': time.time(),
+                'hostname': platform.node(),
+                'python': platform.python_version(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'parameters': vars(args),
+            },
+            'set_boot_seconds': set_boot_seconds,
+            'storms': {},
+        }
+        for i, mode in enumerate(['static', 'dynamic']):
+            url = getattr(args, mode + '_url')
+            pid = None
+            if url is None:
+                port = args.port + i
+                server = multiprocessing.Process(target=serve, args=(bootset, mode, port))
+                server.daemon = True
+                server.start()
+                servers.append(server)
+                if not wait_port(port, 30):
+                    raise RuntimeError(mode + ' http server did not start')
+                url = 'http://127.0.0.1:' + str(port) + '/preboot_execution_environment/nodes/'
+                pid = server.pid
+            results['storms'][mode] = []
+            for storm in range(args.rounds):
+                sys.stderr.write('Boot storm of ' + str(args.nodes) + ' nodes on ' + mode + ' scripts\n')
+                result, bodies = boot_storm(url, nodes, args.concurrency, pid)
+                # Served scripts must be the ones bootset wrote
+                mismatches = 0
+                for node, body in bodies.items():
+                    with open(os.path.join(bootset.pxe_nodes_path, node + '.ipxe'), 'rb') as f:
+                        mismatches += f.read() != body
+                result['content_mismatches'] = mismatches
+                results['storms'][mode].append(result)
+    finally:
+        for server in servers:
+            server.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()